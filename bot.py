@@ -1,45 +1,81 @@
 import asyncio
 import datetime
 import logging
-import logging.handlers
-import os
 import re
 import time
 
 import aiogram
 import humanize
 from aiogram import types
+from aiogram.bot.api import TelegramAPIServer
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import inline_keyboard, reply_keyboard
-from aiogram.utils import deep_linking
 
+import bracket
+import broadcast
 import config
+import content
 import durak
+import intake
+import lifecycle
+import logs
+import matchmaker
+import movelog
+import persistence
+import registry
+import render
 import room
+import sharding
+import stats
+import supervisor
+import webhook
 
 humanize.activate("ru_RU")
 
-if not os.path.exists("./log"):
-    os.mkdir("log")
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("bot")
-fh = logging.handlers.TimedRotatingFileHandler("log/bot.log", encoding="utf-8", when="midnight")
-formatter = logging.Formatter("[%(asctime)s] %(message)s")
-fh.setFormatter(formatter)
-logger.addHandler(fh)
+logs.setup(logger, getattr(config, "LOG_PATH", "log/bot.log"), getattr(config, "LOG_MODE", "queue"))
 logger.info("----- Бот запущен -----")
 
-storage = MemoryStorage()
-bot = aiogram.Bot("5767269718:AAEn1aJi-wAh2A7qhkOeDnDmaKg8eUNKIsM")
+if state_db_path := getattr(config, "STATE_DB_PATH", None):
+    persistence.use(persistence.SQLiteStore(state_db_path))
+    storage = persistence.PersistentMemoryStorage(persistence.backend)
+else:
+    storage = MemoryStorage()
+bot = aiogram.Bot("5767269718:AAEn1aJi-wAh2A7qhkOeDnDmaKg8eUNKIsM",
+                  server=TelegramAPIServer.from_base(getattr(config, "TELEGRAM_API_SERVER", "https://api.telegram.org")))
 
 dp = aiogram.Dispatcher(bot, storage=storage)
-
-queue_default: list[types.User] = []
-queue_trans: list[types.User] = []
-ongoing_games: list[durak.Game] = []
-active_rooms: list[room.Room] = []
+stats.setup(dp)
+sender = broadcast.for_bot(bot)
+user_intake = intake.Intake(rate=getattr(config, "INTAKE_RATE", 5), burst=getattr(config, "INTAKE_BURST", 10),
+                            coalesce=getattr(config, "INTAKE_COALESCE", 1.0), backlog=getattr(config, "INTAKE_BACKLOG", 8))
+
+# variant -> name in messages
+VARIANTS = {"default": "подкидного", "trans": "переводного"}
+
+matchmaking = matchmaker.QueueMatchmaker(matchmaker.Ratings(),
+                                         window=getattr(config, "MATCH_RATING_WINDOW", 100),
+                                         growth=getattr(config, "MATCH_WINDOW_GROWTH", 10))
+room_lifecycle = lifecycle.RoomLifecycle(on_closed=lambda r: drop_room(r),
+                                         start_timeout=getattr(config, "ROOM_START_TIMEOUT", 300),
+                                         end_timeout=getattr(config, "ROOM_END_TIMEOUT", 300))
+metrics_server = None
+
+stats.metrics.gauge("queue_default", lambda: matchmaking.length("default"))
+stats.metrics.gauge("queue_trans", lambda: matchmaking.length("trans"))
+for q in ("p50", "p95", "p99"):
+    stats.metrics.gauge(f"match_wait_{q}", lambda q=q: round(matchmaking.stats()[f"wait_{q}"], 1))
+stats.metrics.gauge("rooms", lambda: len(registry.rooms))
+stats.metrics.gauge("rooms_running", lambda: room_lifecycle.count(lifecycle.State.RUNNING))
+stats.metrics.gauge("games", lambda: supervisor.games.live)
+for key in ("sent", "edited", "skipped", "coalesced"):
+    stats.metrics.gauge(f"render_{key}", lambda key=key: render.for_bot(bot).stats()[key])
+stats.metrics.gauge("send_queues", lambda: len(sender.chats))
+for key in ("throttled", "coalesced", "overflowed"):
+    stats.metrics.gauge(f"intake_{key}", lambda key=key: user_intake.stats()[key])
 
 custom_room_keyboard = reply_keyboard.ReplyKeyboardMarkup()
 custom_room_keyboard.add(reply_keyboard.KeyboardButton(
@@ -51,6 +87,47 @@ custom_room_keyboard.add(reply_keyboard.KeyboardButton(
 custom_room_keyboard.add(reply_keyboard.KeyboardButton("Задать режим *"))
 custom_room_keyboard.add(reply_keyboard.KeyboardButton(
     "Готово, получить пригласительную ссылку"))
+custom_room_keyboard = content.markup(custom_room_keyboard)
+
+gamemode_keyboard = reply_keyboard.ReplyKeyboardMarkup()
+gamemode_keyboard.add(reply_keyboard.KeyboardButton(
+    "Марафон (подкидной дурак)"))
+gamemode_keyboard.add(reply_keyboard.KeyboardButton(
+    "Марафон (переводной дурак)"))
+gamemode_keyboard.add(
+    reply_keyboard.KeyboardButton("Турнир (подкидной дурак)"))
+gamemode_keyboard.add(reply_keyboard.KeyboardButton(
+    "Турнир (переводной дурак)"))
+gamemode_keyboard = content.markup(gamemode_keyboard)
+
+main_menu_keyboard = inline_keyboard.InlineKeyboardMarkup(resize_keyboard=True)
+main_menu_keyboard.add(inline_keyboard.InlineKeyboardButton(
+    "Правила", callback_data="rules"))
+main_menu_keyboard.add(inline_keyboard.InlineKeyboardButton(
+    "FAQ", callback_data="faq"))
+main_menu_keyboard.add(inline_keyboard.InlineKeyboardButton(
+    "Связь с менеджером", url=config.MANAGER_USER_LINK))
+main_menu_keyboard.add(inline_keyboard.InlineKeyboardButton(
+    "Встать в очередь (подкидной)", callback_data="queue_default"))
+main_menu_keyboard.add(inline_keyboard.InlineKeyboardButton(
+    "Встать в очередь (переводной)", callback_data="queue_trans"))
+main_menu_keyboard = content.markup(main_menu_keyboard)
+
+queue_choice_keyboard = inline_keyboard.InlineKeyboardMarkup()
+queue_choice_keyboard.add(inline_keyboard.InlineKeyboardButton(
+    "Подкидной дурак", callback_data="queue_default"))
+queue_choice_keyboard.add(inline_keyboard.InlineKeyboardButton(
+    "Переводной дурак", callback_data="queue_trans"))
+queue_choice_keyboard = content.markup(queue_choice_keyboard)
+
+leave_room_keyboard = content.markup(reply_keyboard.ReplyKeyboardMarkup(resize_keyboard=True).add(
+    reply_keyboard.KeyboardButton("Выйти из комнаты")))
+queue_cancel_keyboard = content.markup(reply_keyboard.ReplyKeyboardMarkup(resize_keyboard=True).add(
+    reply_keyboard.KeyboardButton("Отменить")))
+remove_keyboard = content.markup(reply_keyboard.ReplyKeyboardRemove())
+
+rules = content.CachedMessage(content.TextFile(config.RULES_FILE_PATH), parse_mode="markdown")
+faq = content.CachedMessage(content.TextFile(config.FAQ_FILE_PATH), parse_mode="markdown")
 
 DATETIME_REGEX = r"^([1-9]|(?:[012][0-9])|(?:3[01]))\.([0]{0,1}[1-9]|1[012])\.(\d\d\d\d) ([012]{0,1}[0-9]):([0-6][0-9])$"
 
@@ -64,35 +141,20 @@ class CustomGame(StatesGroup):
 
 @dp.message_handler(commands=['start', 'help', "menu"])
 async def main_menu(message: types.Message):
-    if payload := deep_linking.decode_payload(message.get_args()):
-        for r in active_rooms:
-            if r.unique_id == payload:
-                if (await r.add_player_from_user(message.from_user)):
-                    cancel_keyboard = reply_keyboard.ReplyKeyboardMarkup(resize_keyboard=True).add(
-                        reply_keyboard.KeyboardButton("Выйти из комнаты"))
-                    logger.info(f"{message.from_user.mention} ({message.from_user.id}) успешно заходит в комнату {payload}")
-                    await message.reply("Вы были успешно добавлены в комнату.", reply_markup=cancel_keyboard)
-                else:
-                    logger.info(f"{message.from_user.mention} ({message.from_user.id}) не удаётся зайти в комнату {payload}")
-                    await message.reply("Комната уже заполнена или вы в ней состоите!")
-                break
+    if payload := message.get_args():
+        if r := registry.rooms.by_invite(payload):
+            if (await r.add_player_from_user(message.from_user)):
+                logger.info("%s (%s) успешно заходит в комнату %s", message.from_user.mention, message.from_user.id, r.unique_id)
+                await message.reply("Вы были успешно добавлены в комнату.", reply_markup=leave_room_keyboard)
+            else:
+                logger.info("%s (%s) не удаётся зайти в комнату %s", message.from_user.mention, message.from_user.id, r.unique_id)
+                await message.reply("Комната уже заполнена или вы в ней состоите!")
         else:
-            logger.info(f"{message.from_user.mention} ({message.from_user.id}) пытается зайти в несуществующую комнату {payload}")
+            logger.info("%s (%s) пытается зайти в несуществующую комнату %s", message.from_user.mention, message.from_user.id, payload)
             await message.reply("Нужная комната не была найдена. Удостоверьтесь, что вы не опоздали и получили правильную ссылку.")
 
     else:
-        keyboard = inline_keyboard.InlineKeyboardMarkup(resize_keyboard=True)
-        keyboard.add(inline_keyboard.InlineKeyboardButton(
-            "Правила", callback_data="rules"))
-        keyboard.add(inline_keyboard.InlineKeyboardButton(
-            "FAQ", callback_data="faq"))
-        keyboard.add(inline_keyboard.InlineKeyboardButton(
-            "Связь с менеджером", url=config.MANAGER_USER_LINK))
-        keyboard.add(inline_keyboard.InlineKeyboardButton(
-            "Встать в очередь (подкидной)", callback_data="queue_default"))
-        keyboard.add(inline_keyboard.InlineKeyboardButton(
-            "Встать в очередь (переводной)", callback_data="queue_trans"))
-        await message.reply("Добро пожаловать!\nВнимание: карты кроются в том порядке, в котором были выложены. Не спешите нажимать на кнопки. Они обновляются и вы можете случайно выложить неправильную карту. Вернуть её обратно в руку нельзя.", reply_markup=keyboard)
+        await message.reply("Добро пожаловать!\nВнимание: карты кроются в том порядке, в котором были выложены. Не спешите нажимать на кнопки. Они обновляются и вы можете случайно выложить неправильную карту. Вернуть её обратно в руку нельзя.", reply_markup=main_menu_keyboard)
 
 
 @dp.callback_query_handler()
@@ -100,21 +162,19 @@ async def handle_inlines(query: types.CallbackQuery):
     await query.answer(cache_time=1)
 
     if query.data == "queue_default":
-        await check_and_process_queue(query.from_user, queue_default)
+        await check_and_process_queue(query.from_user, "default")
     elif query.data == "queue_trans":
-        await check_and_process_queue(query.from_user, queue_trans)
+        await check_and_process_queue(query.from_user, "trans")
     elif query.data == "rules":
-        with open(config.RULES_FILE_PATH, "r", encoding="utf-8") as f:
-            await query.message.answer(f.read(), parse_mode="markdown")
+        await rules.send(bot, query.message.chat.id)
     elif query.data == "faq":
-        with open(config.FAQ_FILE_PATH, "r", encoding="utf-8") as f:
-            await query.message.answer(f.read(), parse_mode="markdown")
+        await faq.send(bot, query.message.chat.id)
 
 
 @dp.message_handler(commands=["create", "custom", "create_game", "create_room", "custom_game", "custom_room", "room", "private"], state="*")
 async def create_custom_room(message: types.Message, state: FSMContext):
     if message.from_user.id in config.ADMIN_USER_IDS:
-        logger.info(f"{message.from_user.mention} ({message.from_user.id}) использует команду /room")
+        logger.info("%s (%s) использует команду /room", message.from_user.mention, message.from_user.id)
         await message.reply("Пожалуйста, задайте следующие параметры, потом получите ссылку", reply_markup=custom_room_keyboard)
 
 
@@ -128,15 +188,13 @@ async def delete_custom_room(message: types.Message):
         await message.reply("Укадите айди комнаты (пишется отдельным сообщением после создания комнаты).")
         return
     
-    for r in active_rooms.copy():
-        if r.unique_id == room_id:
-            if r.started:
-                await message.reply("Вы не можете удалить комнату, в которой уже идёт игра!")
-            else:
-                active_rooms.remove(r)
-                for player in r.players:
-                    await bot.send_message(player.user.id, "Комната, в которой вы состоите, была удалена.", reply_markup=reply_keyboard.ReplyKeyboardRemove())
-                await message.reply("Комната была успешно удалена.")
+    if r := registry.rooms.get(room_id):
+        if room_lifecycle.state_of(r) is not lifecycle.State.SCHEDULED:
+            await message.reply("Вы не можете удалить комнату, в которой уже идёт игра!")
+        else:
+            room_lifecycle.discard(r)
+            supervisor.games.spawn(sender.broadcast([p.user.id for p in r.players], "Комната, в которой вы состоите, была удалена.", reply_markup=remove_keyboard))
+            await message.reply("Комната была успешно удалена.")
                 
 
 @dp.message_handler(commands=["kick"])
@@ -149,15 +207,38 @@ async def room_kick(message: types.Message):
         await message.reply("Укажите айди (пишется при заходе в комнату) или @тег игрока.")
         return
 
-    for r in active_rooms:
-        for p in r.players:
-            if (player.isdigit() and int(player) == p.user.id) or (player.startswith("@") and player == p.user.mention):
-                await r.remove_player_from_user(p.user)
-                logger.info(f"{message.from_user.mention} ({message.from_user.id}) кикает {player} из комнаты {r.unique_id}")
-                await bot.send_message(p.user.id, "Администратор кикнул вас из комнаты.", reply_markup=reply_keyboard.ReplyKeyboardRemove())
-                break
-        else:
-            await message.reply("Игрок не был найден ни в одной существующей комнате.")
+    if player.isdigit():
+        user_id = int(player)
+    elif player.startswith("@"):
+        user_id = registry.users.user_id_by_mention(player)
+    else:
+        user_id = None
+    if user_id is None or (r := registry.users.room_of(user_id)) is None:
+        await message.reply("Игрок не был найден ни в одной существующей комнате.")
+        return
+
+    p = r.members[user_id]
+    r.remove_player_from_user(p.user)
+    logger.info("%s (%s) кикает %s из комнаты %s", message.from_user.mention, message.from_user.id, player, r.unique_id, extra={"room": r.unique_id})
+    await sender.send(p.user.id, "Администратор кикнул вас из комнаты.", reply_markup=remove_keyboard)
+
+
+@dp.message_handler(commands=["players", "room_players"])
+async def room_players(message: types.Message):
+    if message.from_user.id not in config.ADMIN_USER_IDS:
+        return
+
+    room_id = message.get_args()
+    if not room_id:
+        await message.reply("Укажите айди комнаты (пишется отдельным сообщением после создания комнаты).")
+        return
+
+    if (r := registry.rooms.get(room_id)) is None:
+        await message.reply("Комната не была найдена.")
+        return
+
+    for page in r.roster():
+        await message.reply(page)
 
 
 @dp.message_handler(state=CustomGame.start_time)
@@ -209,18 +290,6 @@ async def handle_end_time(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=CustomGame.max_players)
 async def handle_max_players(message: types.Message, state: FSMContext):
-    def can_be_split(n: int) -> bool:
-        def split_func(lst, sz): return [lst[i:i+sz]
-                                         for i in range(0, len(lst), sz)]
-        if n < 2:
-            return []
-        
-        for players_per_game in range(6, 1, -1):
-            if n % players_per_game == 0:
-                result = split_func(range(n), players_per_game)
-                return result if (can_be_split(len(result))) or len(result) == 1 else False
-        return False
-
     if message.from_user.id not in config.ADMIN_USER_IDS:
         return
     if message.text.isdigit():
@@ -228,13 +297,16 @@ async def handle_max_players(message: types.Message, state: FSMContext):
             if int(message.text) % 2 != 0 and data.get("gamemode") in room.Gamemode.marathon():
                 await message.reply("Число должно быть чётным!")
                 return
-            elif not can_be_split(int(message.text)) and data.get("gamemode") in room.Gamemode.tournament():
+            elif not bracket.is_playable(int(message.text)) and data.get("gamemode") in room.Gamemode.tournament():
                 await message.reply("Нельзя сыграть турнир таким количеством игроков!")
                 return
 
             data["max_players"] = int(message.text)
             await state.set_state()
-            await message.reply("Максимальное количество игроков успешно установлено", reply_markup=custom_room_keyboard)
+            text = "Максимальное количество игроков успешно установлено"
+            if data.get("gamemode") in room.Gamemode.tournament():
+                text += f"\nСтолы по раундам при полной комнате: {bracket.describe(int(message.text))}"
+            await message.reply(text, reply_markup=custom_room_keyboard)
 
 
 @dp.message_handler(state=CustomGame.gamemode)
@@ -261,178 +333,286 @@ async def handle_gamemode(message: types.Message, state: FSMContext):
 
 @dp.message_handler(commands=["queue", "find_game"])
 async def join_queue(message: types.Message):
-    keyboard = inline_keyboard.InlineKeyboardMarkup()
-    keyboard.add(inline_keyboard.InlineKeyboardButton(
-        "Подкидной дурак", callback_data="queue_default"))
-    keyboard.add(inline_keyboard.InlineKeyboardButton(
-        "Переводной дурак", callback_data="queue_trans"))
-    await message.reply("В какую игру вы хотите сыграть?", reply_markup=keyboard)
-
-
-@dp.message_handler(commands=["queue_default", "find_game_default", "find_default"])
-async def join_default_queue(message: types.Message):
-    await check_and_process_queue(message.from_user, queue_default)
-
-
-@dp.message_handler(commands=["queue_trans", "find_game_trans", "find_trans"])
-async def join_trans_queue(message: types.Message):
-    await check_and_process_queue(message.from_user, queue_trans)
-
-
-async def check_and_process_queue(user: types.User, queue: list[types.User]):
-    game_players = []
-    for g in ongoing_games:
-        game_players.extend([i.user for i in g.players])
-    room_players = []
-    for r in active_rooms:
-        room_players.extend([i.user for i in r.players])
-    if user in queue:
-        await bot.send_message(user.id, "Вы уже состоите в очереди!")
-    elif user in game_players:
-        await bot.send_message(user.id, "Вы уже участвуете в игре!")
-    elif user in room_players:
-        await bot.send_message(user.id, "Вы сейчас находитесь в комнате!")
+    await message.reply("В какую игру вы хотите сыграть?", reply_markup=queue_choice_keyboard)
+
+
+def table_size(message: types.Message) -> int | None:
+    """Number of players from the command arguments, e.g. /find_default 4"""
+    args = message.get_args()
+    if not args:
+        return 2
+    if args.isdigit() and bracket.MIN_TABLE <= int(args) <= bracket.MAX_TABLE:
+        return int(args)
+    return None
+
+
+@dp.message_handler(commands=["queue_default", "find_game_default", "find_default",
+                              "queue_trans", "find_game_trans", "find_trans"])
+async def join_variant_queue(message: types.Message):
+    if (size := table_size(message)) is None:
+        await message.reply(f"Количество игроков за столом должно быть от {bracket.MIN_TABLE} до {bracket.MAX_TABLE}")
+        return
+    variant = "trans" if message.get_command(pure=True).endswith("trans") else "default"
+    await check_and_process_queue(message.from_user, variant, size)
+
+
+@dp.message_handler(commands=["stats"])
+async def show_stats(message: types.Message):
+    if message.from_user.id not in config.ADMIN_USER_IDS:
+        return
+    await message.reply(stats.metrics.report())
+
+
+async def check_and_process_queue(user: types.User, variant: str, size: int = 2):
+    if registry.users.game_of(user.id):
+        await sender.send(user.id, "Вы уже участвуете в игре!")
+        return
+    if registry.users.room_of(user.id):
+        await sender.send(user.id, "Вы сейчас находитесь в комнате!")
+        return
+
+    if sharding.link:
+        # the queues of a sharded bot are kept by the front process
+        result = await sharding.link.request("enqueue", user=user.to_python(), queue=variant, size=size)
+        added, length = not result["already"], result["length"]
+    else:
+        added = matchmaking.put(registry.UserRef.of(user), variant, size)
+        length = matchmaking.length(variant)
+    if not added:
+        await sender.send(user.id, "Вы уже состоите в очереди!")
+        return
+    logger.info("%s (%s) присоединился к очереди в %s дурака (игроков за столом: %s). Длина очереди: %s",
+                user.mention, user.id, VARIANTS[variant], size, length)
+    await sender.send(user.id, "Вы были успешно добавлены в очередь! Вы будете оповещены, когда начнётся игра.", reply_markup=queue_cancel_keyboard)
+
+
+def start_table(variant: str, users: list[registry.UserRef]) -> None:
+    """Starts the game of a table the matchmaker has found"""
+    game = movelog.journal.create_game([durak.Player(u.to_user()) for u in users], bot, is_transferrable=variant == "trans")
+    task = supervisor.games.launch(game)
+    task.add_done_callback(lambda t: record_result([u.id for u in users], t))
+
+
+def record_result(user_ids: list[int], task: asyncio.Task) -> None:
+    if task.cancelled() or task.exception():
+        return
+    winner = task.result()
+    winner_id = None if winner == "draw" or winner is None else winner.user.id
+    if sharding.link:
+        sharding.link.notify("result", user_ids=user_ids, winner_id=winner_id)
     else:
-        keyboard = reply_keyboard.ReplyKeyboardMarkup(resize_keyboard=True)
-        keyboard.add(reply_keyboard.KeyboardButton("Отменить"))
-        queue.append(user)
-        logger.info(f"{user.mention} ({user.id}) присоединился к очереди в {'подкидного' if queue is queue_default else 'переводного'} дурака. Длина очереди: {len(queue)}")
-        await bot.send_message(user.id, "Вы были успешно добавлены в очередь! Вы будете оповещены, когда начнётся игра.", reply_markup=keyboard)
-
-    if len(queue) >= 2:
-        game = durak.Game([durak.Player(p1 := queue.pop()), durak.Player(
-            p2 := queue.pop())], bot=bot, move_time=config.SECONDS_FOR_MOVE, is_transferrable=queue is queue_trans)
-        ongoing_games.append(game)
-        # to ensure that users leave both queues
-        for p in (p1, p2):
-            for q in (queue_default, queue_trans):
-                if p in q:
-                    q.remove(p)
-                    break
-        await game.game_loop()
-        ongoing_games.remove(game)
+        matchmaking.ratings.record(user_ids, winner_id)
 
 
 @dp.message_handler(state="*")
 async def message_handler(message: types.Message, state: FSMContext):
-    await queue_cancel_handler(message)
-    await game_handler(message)
-    await custom_room_handler(message, state)
-    await room_leave_handler(message)
-
-
-async def room_leave_handler(message: types.Message):
-    if message.text.lower() == "выйти из комнаты":
-        for r in active_rooms:
-            for player in r.players:
-                if player.user == message.from_user:
-                    if not r.started:
-                        await r.remove_player_from_user(message.from_user)
-                        logger.info(f"{message.from_user.mention} ({message.from_user.id}) вышел из комнаты {r.unique_id}")
-                        await message.reply("Вы успешно вышли из комнаты", reply_markup=reply_keyboard.ReplyKeyboardRemove())
-                    else:
-                        await message.reply("Вы не можете выйти из комнаты после начала события!")
-                    break
-
-
-async def queue_cancel_handler(message: types.Message):
-    if message.text.lower() == "отменить":
-        if message.from_user in queue_default:
-            queue_default.remove(message.from_user)
-            logger.info(f"{message.from_user.mention} ({message.from_user.id}) вышел из очереди в подкидного дурака")
-            await message.reply("Вы были успешно исключены из очереди в подкидного дурака!", reply_markup=reply_keyboard.ReplyKeyboardRemove())
-        if message.from_user in queue_trans:
-            queue_trans.remove(message.from_user)
-            logger.info(f"{message.from_user.mention} ({message.from_user.id}) вышел из очереди в переводного дурака")
-            await message.reply("Вы были успешно исключены из очереди в переводного дурака!", reply_markup=reply_keyboard.ReplyKeyboardRemove())
+    await user_intake.submit(message.from_user.id, message.text, lambda: dispatch_text(message, state))
 
 
-async def game_handler(message: types.Message):
-    user = message.from_user
-    games = ongoing_games.copy()
-    for r in active_rooms:
-        games.extend(r.games)
-    for g in games:
-        if user in [i.user for i in g.players] and g.current_player.user == user and g.running:
-            await g.move_handler(message)
-            break
+async def dispatch_text(message: types.Message, state: FSMContext):
+    action = text_actions.get(message.text.lower())
+    if action and (message.from_user.id in config.ADMIN_USER_IDS or action not in admin_actions):
+        await action(message, state)
+    else:
+        await game_handler(message)
 
 
-async def custom_room_handler(message: types.Message, state: FSMContext):
-    if message.from_user.id not in config.ADMIN_USER_IDS:
-        return
-    if message.text.lower() == "задать дату и время начала *":
-        await CustomGame.start_time.set()
-        await message.reply("Напишите дату и время начала в формате дд.мм.гггг чч:мм\n" + f"Текущее время на компьютере бота: {room.format_time(time.localtime())}")
-    elif message.text.lower() == "задать дату и время конца":
-        await CustomGame.end_time.set()
-        await message.reply("Напишите дату и время конца в формате дд.мм.гггг чч:мм\n" + f"Текущее время на компьютере бота: {room.format_time(time.localtime())}")
-    elif message.text.lower() == "задать максимальное количество игроков в комнате":
-        await CustomGame.max_players.set()
-        if (await state.get_data()).get("gamemode") in room.Gamemode.marathon():
-            await message.reply("Напишите желаемое максимальное количество игроков (должно быть чётным для марафона):")
+@stats.timed
+async def room_leave_handler(message: types.Message, state: FSMContext):
+    if r := registry.users.room_of(message.from_user.id):
+        if not r.started:
+            r.remove_player_from_user(message.from_user)
+            logger.info("%s (%s) вышел из комнаты %s", message.from_user.mention, message.from_user.id, r.unique_id, extra={"room": r.unique_id})
+            await message.reply("Вы успешно вышли из комнаты", reply_markup=remove_keyboard)
         else:
-            await message.reply("Напишите желаемое максимальное количество игроков (не между любым количеством людей можно сыграть турнир):")
-    elif message.text.lower() == "готово, получить пригласительную ссылку":
-        data = await state.get_data()
-        if (all([data.get("start_time"), data.get("gamemode")])):
-            print(data)
-            new_room = room.Room(data["start_time"], data.get("end_time"), data.get(
-                "max_players"), data.get("gamemode"), admin=message.from_user, bot=bot)
-            active_rooms.append(new_room)
-            
-            start_time = room.format_time(time.localtime(data.get('start_time').timestamp()))
-            end_time = room.format_time(time.localtime(data.get('end_time').timestamp())) if data.get('end_time') else 'нет'
-            gamemode = str(data['gamemode'])
-            max_players = data.get('max_players') or 'не ограничено'
-            event_eta = humanize.precisedelta(datetime.datetime.now() - data.get('start_time'), minimum_unit='minutes')
-            invite_link = await new_room.invite_link
-            
-            logger.info(f"{message.from_user.mention} ({message.from_user.id}) создал новую комнату: {start_time} - {end_time}, {gamemode}, до {max_players} чел.; через: {event_eta};   {invite_link}")
-            
-            await message.reply(f"Вы успешно создали комнату!\nДата начала: {start_time}\nДата конца: {end_time}\nРежим: {gamemode}\nМаксимальное количество игроков: {max_players}\nСобытие начнётся через: {event_eta}\n\nВсе игроки должны перейти по следующей ссылке: {invite_link}\nОднако администратору, создавшему комнату, всё равно будут приходить некоторые уведомления о ходе события.", reply_markup=reply_keyboard.ReplyKeyboardRemove())
-            await message.reply(f"Айди для удаления комнаты: {new_room.unique_id}")
-
-            await state.finish()
+            await message.reply("Вы не можете выйти из комнаты после начала события!")
+
 
+@stats.timed
+async def queue_cancel_handler(message: types.Message, state: FSMContext):
+    for variant, name in VARIANTS.items():
+        if sharding.link:
+            left = await sharding.link.request("dequeue", user_id=message.from_user.id, queue=variant)
         else:
-            print(data)
-            await message.reply("Укажите все данные, помеченные звёздочкой!")
-    elif message.text.lower() == "задать максимальное количество игроков в комнате *":
-        await CustomGame.max_players.set()
-        await message.reply("Напишите максимальное количество игроков в комнате")
-    elif message.text.lower() == "задать режим *":
-        gamemode_keyboard = reply_keyboard.ReplyKeyboardMarkup()
-        gamemode_keyboard.add(reply_keyboard.KeyboardButton(
-            "Марафон (подкидной дурак)"))
-        gamemode_keyboard.add(reply_keyboard.KeyboardButton(
-            "Марафон (переводной дурак)"))
-        gamemode_keyboard.add(
-            reply_keyboard.KeyboardButton("Турнир (подкидной дурак)"))
-        gamemode_keyboard.add(reply_keyboard.KeyboardButton(
-            "Турнир (переводной дурак)"))
-        await CustomGame.gamemode.set()
-        await message.reply("Выберите режим игры", reply_markup=gamemode_keyboard)
-
-
-async def check_rooms():
-    while True:
-        for r in active_rooms.copy():
-            if not r.started and datetime.datetime.now() >= r.start_time:
-                await r.start()
-                if r.started:
-                    print("starting a room")
-                    asyncio.create_task(r.loop())
-            elif (r.started and not r.running):
-                await r.end()
-                active_rooms.remove(r)
-            elif r.end_time:
-                if datetime.datetime.now() >= r.end_time:
-                    await r.end()
-                    active_rooms.remove(r)
-        await asyncio.sleep(30)
+            left = matchmaking.discard(message.from_user.id, variant)
+        if left:
+            logger.info("%s (%s) вышел из очереди в %s дурака", message.from_user.mention, message.from_user.id, name)
+            await message.reply(f"Вы были успешно исключены из очереди в {name} дурака!", reply_markup=remove_keyboard)
+
+
+@stats.timed
+async def game_handler(message: types.Message):
+    user = message.from_user
+    g = registry.users.game_of(user.id)
+    if g and g.current_player.user == user and g.running:
+        movelog.journal.move(g, user.id, message.text)
+        await g.move_handler(message)
+
+
+@stats.timed
+async def room_start_time_handler(message: types.Message, state: FSMContext):
+    await CustomGame.start_time.set()
+    await message.reply("Напишите дату и время начала в формате дд.мм.гггг чч:мм\n" + f"Текущее время на компьютере бота: {room.format_time(time.localtime())}")
+
+
+@stats.timed
+async def room_end_time_handler(message: types.Message, state: FSMContext):
+    await CustomGame.end_time.set()
+    await message.reply("Напишите дату и время конца в формате дд.мм.гггг чч:мм\n" + f"Текущее время на компьютере бота: {room.format_time(time.localtime())}")
+
+
+@stats.timed
+async def room_max_players_hint_handler(message: types.Message, state: FSMContext):
+    await CustomGame.max_players.set()
+    if (await state.get_data()).get("gamemode") in room.Gamemode.marathon():
+        await message.reply("Напишите желаемое максимальное количество игроков (должно быть чётным для марафона):")
+    else:
+        await message.reply("Напишите желаемое максимальное количество игроков (не между любым количеством людей можно сыграть турнир):")
+
+
+@stats.timed
+async def room_max_players_handler(message: types.Message, state: FSMContext):
+    await CustomGame.max_players.set()
+    await message.reply("Напишите максимальное количество игроков в комнате")
+
+
+@stats.timed
+async def room_gamemode_handler(message: types.Message, state: FSMContext):
+    await CustomGame.gamemode.set()
+    await message.reply("Выберите режим игры", reply_markup=gamemode_keyboard)
+
+
+@stats.timed
+async def room_create_handler(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    if (all([data.get("start_time"), data.get("gamemode")])):
+        logger.debug("Создание комнаты: %s", data)
+        new_room = room.Room(data["start_time"], data.get("end_time"), data.get(
+            "max_players"), data.get("gamemode"), admin=message.from_user, bot=bot)
+        add_room(new_room)
+        new_room.save()
+        
+        start_time = room.format_time(time.localtime(data.get('start_time').timestamp()))
+        end_time = room.format_time(time.localtime(data.get('end_time').timestamp())) if data.get('end_time') else 'нет'
+        gamemode = str(data['gamemode'])
+        max_players = data.get('max_players') or 'не ограничено'
+        event_eta = humanize.precisedelta(datetime.datetime.now() - data.get('start_time'), minimum_unit='minutes')
+        invite_link = await new_room.create_invite_link()
+        
+        logger.info("%s (%s) создал новую комнату: %s - %s, %s, до %s чел.; через: %s;   %s", message.from_user.mention, message.from_user.id, start_time, end_time, gamemode, max_players, event_eta, invite_link)
+        
+        await message.reply(f"Вы успешно создали комнату!\nДата начала: {start_time}\nДата конца: {end_time}\nРежим: {gamemode}\nМаксимальное количество игроков: {max_players}\nСобытие начнётся через: {event_eta}\n\nВсе игроки должны перейти по следующей ссылке: {invite_link}\nОднако администратору, создавшему комнату, всё равно будут приходить некоторые уведомления о ходе события.", reply_markup=remove_keyboard)
+        await message.reply(f"Айди для удаления комнаты: {new_room.unique_id}")
+
+        await state.finish()
+
+    else:
+        logger.debug("Не хватает данных для создания комнаты: %s", data)
+        await message.reply("Укажите все данные, помеченные звёздочкой!")
+
+
+# lowercased button text -> handler, the texts of no button are moves
+text_actions = {
+    "отменить": queue_cancel_handler,
+    "выйти из комнаты": room_leave_handler,
+    "задать дату и время начала *": room_start_time_handler,
+    "задать дату и время конца": room_end_time_handler,
+    "задать максимальное количество игроков в комнате": room_max_players_hint_handler,
+    "задать максимальное количество игроков в комнате *": room_max_players_handler,
+    "задать режим *": room_gamemode_handler,
+    "готово, получить пригласительную ссылку": room_create_handler,
+}
+admin_actions = {room_start_time_handler, room_end_time_handler, room_max_players_hint_handler,
+                 room_max_players_handler, room_gamemode_handler, room_create_handler}
+
+
+def add_room(r: room.Room):
+    registry.rooms.add(r)
+    room_lifecycle.add(r)
+    if sharding.link:
+        sharding.link.notify("room", room=r.unique_id, payload=r.payload)
+
+
+def drop_room(r: room.Room):
+    """Called by room_lifecycle once the room is closed"""
+    registry.rooms.remove(r)
+    registry.users.remove_room(r)
+    r.forget()
+    r.forget_messages()
+    if sharding.link:
+        sharding.link.notify("room_closed", room=r.unique_id, payload=r.payload)
+
+
+async def restore_state():
+    for snapshot in persistence.backend.load("room").values():
+        r = room.Room.restore(snapshot, bot)
+        if not r.resumable:
+            logger.info("Турнир в комнате %s прерван перезапуском и завершён", r.unique_id, extra={"room": r.unique_id})
+            await r.send_message(r.everyone, "Бот был перезапущен во время турнира. Продолжить сетку с того же места нельзя, поэтому турнир завершён без победителя.")
+            registry.users.remove_room(r)
+            r.forget()
+            continue
+        logger.info("Комната %s восстановлена после перезапуска (%s чел.)", r.unique_id, len(r.players), extra={"room": r.unique_id})
+        if r.started:
+            # games in progress are lost, the event goes on from the saved players and scores
+            await r.send_message(r.everyone, "Бот был перезапущен. Событие продолжается, текущие игры начинаются заново.")
+        add_room(r)
+
+    for path in movelog.journal.unfinished():
+        log = movelog.read(path)
+        if log.flags & movelog.FLAG_ROOM:
+            # rooms restart their games themselves
+            movelog.journal.abort(path)
+            continue
+        game, task, in_sync = await movelog.replay(log, movelog.OfflineBot())
+        aiogram.Bot.set_current(bot)
+        if not in_sync:
+            # the game went another way than the log, e.g. a move timed out: the players wouldn't see their game
+            game.running = False
+            task.cancel()
+            movelog.journal.abort(path)
+            logger.warning("[%s] Игра из журнала %s разошлась с ним при восстановлении и прервана", game.unique_id, path, extra={"game": game.unique_id})
+            await sender.broadcast([u.id for u in log.players], "Бот был перезапущен. Вашу игру не удалось восстановить, она прервана.")
+            continue
+        if task.done():
+            movelog.journal.abort(path)
+            continue
+        # from here on the game talks to the players again
+        game.bot = bot
+        movelog.journal.adopt(game, path, log)
+        supervisor.games.adopt(game, task)
+        logger.info("[%s] Игра восстановлена из журнала %s (%s ходов)", game.unique_id, path, len(log.moves), extra={"game": game.unique_id})
+        await sender.broadcast([u.id for u in log.players], "Бот был перезапущен, ваша игра восстановлена. Продолжайте с того места, где остановились.")
+
+    if not sharding.link:
+        matchmaking.ratings.restore()
+        matchmaking.restore()
 
 
 async def on_startup(_dp):
-    asyncio.create_task(check_rooms())
-aiogram.executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
+    global metrics_server
+    await restore_state()
+    asyncio.create_task(room_lifecycle.run())
+    if not sharding.link:
+        asyncio.create_task(matchmaking.run(start_table))
+    asyncio.create_task(stats.watch_loop())
+    if port := getattr(config, "METRICS_PORT", None):
+        metrics_server = await stats.serve(getattr(config, "METRICS_HOST", "127.0.0.1"), port)
+
+
+async def on_shutdown(_dp):
+    if metrics_server:
+        await metrics_server.cleanup()
+    for r in registry.rooms:
+        r.save()
+    persistence.backend.close()
+    movelog.journal.close()
+
+
+if __name__ == "__main__":
+    if shards := getattr(config, "SHARDS", 0):
+        sharding.run(bot, shards)
+    elif getattr(config, "WEBHOOK_URL", None):
+        webhook.run(dp, on_startup=on_startup, on_shutdown=on_shutdown)
+    else:
+        aiogram.executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
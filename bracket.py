@@ -0,0 +1,142 @@
+import asyncio
+import functools
+import time
+from typing import Awaitable, Callable
+
+MIN_TABLE = 2
+MAX_TABLE = 6
+
+
+class Round:
+    def __init__(self, tables: tuple[int, ...], byes: int):
+        self.tables = tables
+        self.byes = byes
+
+    @property
+    def players(self) -> int:
+        return sum(self.tables) + self.byes
+
+    @property
+    def advancing(self) -> int:
+        return len(self.tables) + self.byes
+
+    def __str__(self):
+        text = "+".join(map(str, self.tables))
+        return f"{text} (+{self.byes} без игры)" if self.byes else text
+
+
+@functools.lru_cache(maxsize=None)
+def plan(players: int, max_table: int = MAX_TABLE) -> tuple[Round, ...]:
+    """
+    Splits the players into rounds of tables with MIN_TABLE..max_table players each;
+    one winner of every table and the players with a bye go to the next round.
+    Tables of a round differ in size by at most one player.
+    """
+    if players < MIN_TABLE:
+        return ()
+
+    rounds = []
+    while players > 1:
+        count = -(-players // max_table)
+        size, bigger = divmod(players, count)
+        tables = [size + 1] * bigger + [size] * (count - bigger)
+        # a "table" of one player is a bye
+        byes = tables.count(1)
+        rounds.append(Round(tuple(t for t in tables if t >= MIN_TABLE), byes))
+        players = rounds[-1].advancing
+    return tuple(rounds)
+
+
+def is_playable(players: int) -> bool:
+    return bool(plan(players))
+
+
+def describe(players: int) -> str:
+    return " → ".join(str(r) for r in plan(players)) + " → 1"
+
+
+class Timing:
+    def __init__(self, tables: int):
+        self.tables = tables
+        self.first_start: float | None = None
+        self.last_end: float | None = None
+        # the longest table of the round, the part of the critical path it adds
+        self.longest = 0.0
+
+    def started(self, at: float) -> None:
+        self.first_start = at if self.first_start is None else min(self.first_start, at)
+
+    def finished(self, started: float, at: float) -> None:
+        self.last_end = at if self.last_end is None else max(self.last_end, at)
+        self.longest = max(self.longest, at - started)
+
+    @property
+    def span(self) -> float:
+        return (self.last_end or 0.0) - (self.first_start or 0.0)
+
+
+class Bracket:
+    """
+    Plays the rounds of plan() without a barrier between them. Every round seats
+    the winners of the tables in table order, then the players with a bye, at
+    tables of the sizes plan() gives. A table of the next round starts as soon
+    as the tables feeding its seats have their winners, so fast tables don't wait
+    for the slowest one of their round.
+    """
+
+    def __init__(self, players: list, play: Callable[[int, int, list], Awaitable],
+                 on_byes: Callable[[int, list], Awaitable] | None = None, max_table: int = MAX_TABLE):
+        self.players = players
+        # play(round, table, players) -> winner of the table
+        self.play = play
+        self.on_byes = on_byes
+        self.rounds = plan(len(players), max_table)
+        self.timings = [Timing(len(r.tables)) for r in self.rounds]
+        self.started: float | None = None
+        self.finished: float | None = None
+
+    async def _table(self, index: int, table: int, seats: list[asyncio.Future], result: asyncio.Future) -> None:
+        players = list(await asyncio.gather(*seats))
+        timing = self.timings[index]
+        started = time.monotonic()
+        timing.started(started)
+        winner = await self.play(index, table, players)
+        timing.finished(started, time.monotonic())
+        result.set_result(winner)
+
+    async def _byes(self, index: int, seats: list[asyncio.Future]) -> None:
+        await self.on_byes(index, list(await asyncio.gather(*seats)))
+
+    async def run(self):
+        """Plays the whole bracket and returns the winner"""
+        loop = asyncio.get_running_loop()
+        self.started = time.monotonic()
+        seats = []
+        for player in self.players:
+            seats.append(seat := loop.create_future())
+            seat.set_result(player)
+
+        async with asyncio.TaskGroup() as tg:
+            for index, rnd in enumerate(self.rounds):
+                advancing = []
+                offset = 0
+                for table, size in enumerate(rnd.tables):
+                    advancing.append(result := loop.create_future())
+                    tg.create_task(self._table(index, table, seats[offset:offset + size], result))
+                    offset += size
+                byes = seats[offset:]
+                if byes and self.on_byes:
+                    tg.create_task(self._byes(index, byes))
+                seats = advancing + byes
+        self.finished = time.monotonic()
+        return seats[0].result()
+
+    def report(self) -> str:
+        lines = []
+        for index, timing in enumerate(self.timings):
+            lines.append(f"раунд {index + 1}: {timing.tables} стол(ов), самый долгий стол {timing.longest:.0f} с, "
+                         f"от первого старта до последнего финиша {timing.span:.0f} с")
+        total = (self.finished or time.monotonic()) - (self.started or time.monotonic())
+        barrier = sum(t.longest for t in self.timings)
+        lines.append(f"всего {total:.0f} с, с ожиданием целых раундов было бы не меньше {barrier:.0f} с")
+        return "; ".join(lines)
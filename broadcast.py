@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+
+from aiogram import Bot, exceptions, types
+
+import config
+
+logger = logging.getLogger("bot")
+
+UNREACHABLE = (exceptions.BotBlocked, exceptions.UserDeactivated, exceptions.ChatNotFound)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def is_idle(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.paused_until
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ChatQueue:
+    """Keeps messages to one chat in order and applies its own flood-wait"""
+
+    def __init__(self, rate: float, burst: int):
+        self.lock = asyncio.Lock()
+        self.bucket = TokenBucket(rate, burst)
+        self.pending = 0
+
+
+class Broadcaster:
+    """
+    Sends messages within Telegram limits: a global token bucket for the bot,
+    a per-chat bucket and at most `concurrency` requests in flight.
+    Flood-wait of one chat only delays messages to that chat.
+    """
+
+    def __init__(self, bot: Bot, rate: float = 25, chat_rate: float = 1, chat_burst: int = 3,
+                 concurrency: int = 16, max_retries: int = 5):
+        self.bot = bot
+        self.bucket = TokenBucket(rate, rate)
+        self.fanout = asyncio.Semaphore(concurrency)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.chats: dict[int, ChatQueue] = {}
+
+    async def _send(self, chat_id: int, text: str, **kwargs) -> types.Message | None:
+        """Raises one of UNREACHABLE if the user can't be messaged"""
+        return await self._call(chat_id, lambda: self.bot.send_message(chat_id, text, **kwargs))
+
+    async def _call(self, chat_id: int, request: Callable[[], Awaitable]):
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = ChatQueue(self.chat_rate, self.chat_burst)
+        chat.pending += 1
+        try:
+            async with chat.lock:
+                for _ in range(self.max_retries):
+                    await chat.bucket.acquire()
+                    await self.bucket.acquire()
+                    try:
+                        async with self.fanout:
+                            return await request()
+                    except exceptions.RetryAfter as exc:
+                        logger.info("Flood-wait %s с. для чата %s", exc.timeout, chat_id)
+                        chat.bucket.pause(exc.timeout)
+                logger.warning("Сообщение в чат %s не отправлено после %s попыток", chat_id, self.max_retries)
+                return None
+        finally:
+            chat.pending -= 1
+            if not chat.pending and chat.bucket.is_idle():
+                del self.chats[chat_id]
+
+    async def send(self, chat_id: int, text: str, **kwargs) -> types.Message | None:
+        try:
+            return await self._send(chat_id, text, **kwargs)
+        except UNREACHABLE:
+            logger.info("Пользователь %s недоступен для бота", chat_id)
+            return None
+
+    async def edit(self, chat_id: int, message_id: int, text: str, **kwargs) -> None:
+        """Edits a message sent earlier, within the same limits as sending"""
+        try:
+            await self._call(chat_id, lambda: self.bot.edit_message_text(text, chat_id, message_id, **kwargs))
+        except UNREACHABLE:
+            logger.info("Пользователь %s недоступен для бота", chat_id)
+
+    async def broadcast(self, chat_ids: list[int], text: str, **kwargs) -> list[int]:
+        """Sends the text to every chat concurrently and returns the ones that are unreachable"""
+        return await self.broadcast_each({i: text for i in chat_ids}, **kwargs)
+
+    async def broadcast_each(self, texts: dict[int, str], **kwargs) -> list[int]:
+        """Same as broadcast, but every chat gets its own text"""
+        unreachable = []
+
+        async def deliver(chat_id: int, text: str):
+            try:
+                await self._send(chat_id, text, **kwargs)
+            except UNREACHABLE:
+                unreachable.append(chat_id)
+            except exceptions.TelegramAPIError as exc:
+                logger.warning("Не удалось отправить сообщение в чат %s: %s", chat_id, exc)
+
+        await asyncio.gather(*(deliver(i, text) for i, text in texts.items()))
+        return unreachable
+
+
+_broadcasters: dict[int, Broadcaster] = {}
+
+
+def for_bot(bot: Bot) -> Broadcaster:
+    """Returns the shared broadcaster of the bot, limits are global per bot token"""
+    if id(bot) not in _broadcasters:
+        _broadcasters[id(bot)] = Broadcaster(
+            bot,
+            rate=getattr(config, "BROADCAST_RATE", 25),
+            concurrency=getattr(config, "BROADCAST_CONCURRENCY", 16),
+        )
+    return _broadcasters[id(bot)]
@@ -0,0 +1,64 @@
+import json
+import os
+import time
+
+from aiogram import Bot, exceptions, types
+
+# how often a file's mtime is checked, seconds
+RELOAD_INTERVAL = 5
+
+
+def markup(keyboard: types.base.TelegramObject) -> str:
+    """Serializes the keyboard once, aiogram sends strings as they are"""
+    return json.dumps(keyboard.to_python(), ensure_ascii=False)
+
+
+class TextFile:
+    """Text of a file, read again only when the file's mtime changes"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.version = 0
+        self._text = ""
+        self._mtime = None
+        self._checked = -RELOAD_INTERVAL
+
+    @property
+    def text(self) -> str:
+        now = time.monotonic()
+        if now - self._checked >= RELOAD_INTERVAL:
+            self._checked = now
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime != self._mtime:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._text = f.read()
+                self._mtime = mtime
+                self.version += 1
+        return self._text
+
+
+class CachedMessage:
+    """
+    Sends the text of a file. After the first send the message is copied with
+    copyMessage, so the text isn't uploaded again until the file changes
+    """
+
+    def __init__(self, file: TextFile, **kwargs):
+        self.file = file
+        self.kwargs = kwargs
+        self.source: tuple[int, int] | None = None
+        self.version = 0
+
+    async def send(self, bot: Bot, chat_id: int) -> None:
+        text = self.file.text
+        if self.source and self.version == self.file.version:
+            try:
+                await bot.copy_message(chat_id, *self.source)
+                return
+            except exceptions.TelegramAPIError:
+                # the original may be gone or its chat unusable (deleted, bot blocked), which can't be told
+                # from a problem with the recipient: the text is sent as is and becomes the new original
+                self.source = None
+        message = await bot.send_message(chat_id, text, **self.kwargs)
+        self.source = (message.chat.id, message.message_id)
+        self.version = self.file.version
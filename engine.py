@@ -0,0 +1,317 @@
+"""
+Rules of durak without Telegram: cards are ints 0..35 (suit * 9 + rank), hands
+and the cards on the table are 36-bit masks, moves are small ints.
+
+    python engine.py --games 100000 --agent greedy           # self-play benchmark
+    python engine.py --games 10000 --players 4 --transfer --check
+
+The results of a seed don't change unless the rules do, so the printed line
+doubles as a regression check.
+"""
+import argparse
+import random
+import sys
+import time
+from typing import Callable
+
+RANKS = ("6", "7", "8", "9", "10", "В", "Д", "К", "Т")
+SUITS = ("♠", "♣", "♦", "♥")
+CARDS = len(RANKS) * len(SUITS)
+HAND = 6
+MAX_PLAYERS = 6
+
+RANK = [c % len(RANKS) for c in range(CARDS)]
+SUIT = [c // len(RANKS) for c in range(CARDS)]
+# every card of the rank
+RANK_CARDS = [sum(1 << (s * len(RANKS) + r) for s in range(len(SUITS))) for r in range(len(RANKS))]
+SUIT_CARDS = [((1 << len(RANKS)) - 1) << (s * len(RANKS)) for s in range(len(SUITS))]
+# BEATERS[trump][card]: the cards that beat the card
+BEATERS = [[sum(1 << d for d in range(CARDS)
+                if SUIT[d] == SUIT[a] and RANK[d] > RANK[a] or SUIT[d] == trump != SUIT[a])
+            for a in range(CARDS)] for trump in range(len(SUITS))]
+
+# moves: 0..35 put the card on the table (attack, throw in or beat the oldest unbeaten card),
+# TRANSFER + card passes the attack on, TAKE and PASS end the turn
+TAKE = CARDS
+PASS = CARDS + 1
+TRANSFER = CARDS + 2
+
+
+def card_name(card: int) -> str:
+    return RANKS[RANK[card]] + SUITS[SUIT[card]]
+
+
+def move_name(move: int) -> str:
+    if move == TAKE:
+        return "взять"
+    if move == PASS:
+        return "пас"
+    if move >= TRANSFER:
+        return "перевести " + card_name(move - TRANSFER)
+    return card_name(move)
+
+
+def cards_of(mask: int) -> list[int]:
+    cards = []
+    while mask:
+        low = mask & -mask
+        cards.append(low.bit_length() - 1)
+        mask ^= low
+    return cards
+
+
+class State:
+    """
+    One game. `to_move` is the player who decides next; attackers throw in one
+    card at a time and the defender answers every card before the next one comes.
+    """
+
+    __slots__ = ("players", "transferrable", "hands", "deck", "trump", "trump_card", "attack", "defense",
+                 "table_ranks", "attacker", "defender", "to_move", "passes", "limit", "out", "finished", "loser",
+                 "moves", "discarded")
+
+    def __init__(self, players: int, rng: random.Random, transferrable: bool = False):
+        if not 2 <= players <= MAX_PLAYERS:
+            raise ValueError(f"{players} players, expected 2..{MAX_PLAYERS}")
+        self.players = players
+        self.transferrable = transferrable
+        self.deck = list(range(CARDS))
+        rng.shuffle(self.deck)
+        self.hands = [0] * players
+        for _ in range(HAND):
+            for p in range(players):
+                self.hands[p] |= 1 << self.deck.pop()
+        # the bottom card of the deck shows the trump and is drawn last
+        self.trump_card = self.deck[0] if self.deck else None
+        self.trump = SUIT[self.trump_card] if self.deck else SUIT[rng.randrange(CARDS)]
+        self.attack: list[int] = []
+        self.defense: list[int] = []
+        self.table_ranks = 0
+        self.out: list[int] = []
+        self.finished = False
+        self.loser: int | None = None
+        self.moves = 0
+        self.discarded = 0
+
+        # the lowest trump starts
+        trumps = [(self.hands[p] & SUIT_CARDS[self.trump]) for p in range(players)]
+        starter = min((p for p in range(players) if trumps[p]), key=lambda p: trumps[p] & -trumps[p], default=0)
+        self._start_round(starter)
+
+    def _active(self, player: int) -> bool:
+        return player not in self.out
+
+    def _next(self, player: int) -> int:
+        for step in range(1, self.players + 1):
+            if self._active(candidate := (player + step) % self.players):
+                return candidate
+        return player
+
+    def _attackers(self) -> list[int]:
+        """Main attacker first, then the others in seating order"""
+        result = [self.attacker]
+        p = self._next(self.defender)
+        while p not in (self.attacker, self.defender):
+            result.append(p)
+            p = self._next(p)
+        return result
+
+    def _start_round(self, attacker: int) -> None:
+        self.attack.clear()
+        self.defense.clear()
+        self.table_ranks = 0
+        self.attacker = attacker
+        self.defender = self._next(attacker)
+        self.limit = min(HAND, self.hands[self.defender].bit_count())
+        self.to_move = attacker
+        self.passes = 0
+
+    def _can_throw(self) -> bool:
+        unbeaten = len(self.attack) - len(self.defense)
+        return len(self.attack) < self.limit and unbeaten < self.hands[self.defender].bit_count()
+
+    def legal(self) -> list[int]:
+        if self.finished:
+            return []
+        hand = self.hands[self.to_move]
+        if self.to_move == self.defender:
+            moves = cards_of(hand & BEATERS[self.trump][self.attack[len(self.defense)]])
+            if self.transferrable and not self.defense:
+                # the next player must be able to answer every card, the transferred one too
+                nxt = self._next(self.defender)
+                if nxt != self.defender and self.hands[nxt].bit_count() > len(self.attack):
+                    moves += [TRANSFER + c for c in cards_of(hand & RANK_CARDS[RANK[self.attack[0]]])]
+            moves.append(TAKE)
+            return moves
+        if not self.attack:
+            return cards_of(hand)
+        moves = cards_of(hand & self.table_ranks) if self._can_throw() else []
+        moves.append(PASS)
+        return moves
+
+    def _put(self, card: int) -> None:
+        self.hands[self.to_move] &= ~(1 << card)
+        self.table_ranks |= RANK_CARDS[RANK[card]]
+
+    def apply(self, move: int) -> None:
+        self.moves += 1
+        if move == TAKE:
+            for card in self.attack + self.defense:
+                self.hands[self.defender] |= 1 << card
+            self._end_round(taken=True)
+        elif move == PASS:
+            self.passes += 1
+            attackers = [p for p in self._attackers() if self.hands[p]]
+            if self.passes >= len(attackers):
+                self._end_round(taken=False)
+            else:
+                self.to_move = attackers[self.passes]
+        elif move >= TRANSFER:
+            card = move - TRANSFER
+            self._put(card)
+            self.attack.append(card)
+            self.attacker, self.defender = self.defender, self._next(self.defender)
+            self.limit = min(HAND, self.hands[self.defender].bit_count())
+            self.to_move = self.defender
+        elif self.to_move == self.defender:
+            self._put(move)
+            self.defense.append(move)
+            if len(self.defense) == len(self.attack):
+                # every card is beaten, the attackers may throw in more, the main one first
+                self.passes = 0
+                self.to_move = self.attacker if self.hands[self.attacker] else self._first_attacker_with_cards()
+                if self.to_move is None:
+                    self._end_round(taken=False)
+        else:
+            self._put(move)
+            self.attack.append(move)
+            self.to_move = self.defender
+
+    def _first_attacker_with_cards(self) -> int | None:
+        for p in self._attackers():
+            if self.hands[p]:
+                return p
+        return None
+
+    def _end_round(self, taken: bool) -> None:
+        if not taken:
+            self.discarded += len(self.attack) + len(self.defense)
+        # refill: attackers in order, the defender last
+        for p in self._attackers() + [self.defender]:
+            while self.deck and self.hands[p].bit_count() < HAND:
+                self.hands[p] |= 1 << self.deck.pop()
+        if not self.deck:
+            for p in range(self.players):
+                if self._active(p) and not self.hands[p]:
+                    self.out.append(p)
+        active = [p for p in range(self.players) if self._active(p)]
+        if len(active) <= 1:
+            self.finished = True
+            self.loser = active[0] if active else None
+            return
+        if taken:
+            self._start_round(self._next(self.defender))
+        elif self._active(self.defender):
+            self._start_round(self.defender)
+        else:
+            self._start_round(self._next(self.defender))
+
+    def cards(self) -> int:
+        """Cards in hands, on the table, in the deck and in the discard pile, always 36"""
+        on_table = 0 if self.finished else len(self.attack) + len(self.defense)
+        return sum(h.bit_count() for h in self.hands) + on_table + len(self.deck) + self.discarded
+
+
+Agent = Callable[[State, list[int], random.Random], int]
+
+
+def random_agent(state: State, moves: list[int], rng: random.Random) -> int:
+    return moves[rng.randrange(len(moves))]
+
+
+def greedy_agent(state: State, moves: list[int], rng: random.Random) -> int:
+    """Plays the cheapest card, keeps trumps; throws in only cards that aren't trumps"""
+    best = None
+    best_cost = None
+    for move in moves:
+        if move >= TAKE and move < TRANSFER:
+            continue
+        card = move - TRANSFER if move >= TRANSFER else move
+        trump = SUIT[card] == state.trump
+        if trump and state.attack and state.to_move != state.defender:
+            continue
+        # transferring costs no beating card, so it's preferred over the same card
+        cost = (trump, RANK[card], move < TRANSFER)
+        if best_cost is None or cost < best_cost:
+            best, best_cost = move, cost
+    if best is not None:
+        return best
+    return TAKE if TAKE in moves else PASS
+
+
+AGENTS = {"random": random_agent, "greedy": greedy_agent}
+
+
+def play(players: int, agents: list[Agent], rng: random.Random, transferrable: bool = False,
+         check: bool = False, max_moves: int = 2000) -> State:
+    """
+    Plays one game out. Two players that answer each other the same way can go
+    round forever, such a game stops unfinished after `max_moves`.
+    """
+    state = State(players, rng, transferrable)
+    while not state.finished and state.moves < max_moves:
+        moves = state.legal()
+        move = agents[state.to_move](state, moves, rng)
+        if check:
+            if move not in moves:
+                raise AssertionError(f"illegal move {move_name(move)}")
+        state.apply(move)
+        if check and state.cards() != CARDS:
+            raise AssertionError(f"{state.cards()} cards after {move_name(move)}")
+    return state
+
+
+def benchmark(games: int, players: int, agent: str, transferrable: bool, check: bool, seed: int) -> dict:
+    rng = random.Random(seed)
+    agents = [AGENTS[agent]] * players
+    losers = [0] * (players + 1)
+    moves = 0
+    stalled = 0
+    started = time.perf_counter()
+    for _ in range(games):
+        state = play(players, agents, rng, transferrable, check)
+        moves += state.moves
+        if not state.finished:
+            stalled += 1
+            continue
+        losers[players if state.loser is None else state.loser] += 1
+    elapsed = time.perf_counter() - started
+    return {
+        "games": games,
+        "games_per_second": games / elapsed,
+        "moves_per_second": moves / elapsed,
+        "moves_per_game": moves / games,
+        "draws": losers[players] / games,
+        "stalled": stalled,
+        "losers": losers[:players],
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--games", type=int, default=100000)
+    parser.add_argument("--players", type=int, default=2)
+    parser.add_argument("--agent", choices=AGENTS, default="random")
+    parser.add_argument("--transfer", action="store_true", help="perevodnoy: the defender may pass the attack on")
+    parser.add_argument("--check", action="store_true", help="verify legality and card count after every move")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    result = benchmark(args.games, args.players, args.agent, args.transfer, args.check, args.seed)
+    print(f"{result['games']} games: {result['games_per_second']:.0f} games/s, {result['moves_per_second']:.0f} moves/s, "
+          f"{result['moves_per_game']:.1f} moves/game, draws {result['draws']:.1%}, "
+          f"stalled {result['stalled']}, losers by seat {result['losers']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
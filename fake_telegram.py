@@ -0,0 +1,177 @@
+"""
+Offline harness for webhook mode: a fake Bot API server and a client that POSTs
+recorded updates to the bot's webhook, then reports the throughput.
+
+Run the harness first
+    python fake_telegram.py updates.jsonl
+    python fake_telegram.py --synthetic 1000
+then start the bot with WEBHOOK_URL = "http://127.0.0.1:8080" and
+TELEGRAM_API_SERVER = "http://127.0.0.1:8081" in config.
+The updates are posted as soon as the webhook starts answering.
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import random
+import time
+
+import aiohttp
+from aiohttp import web
+
+BOT_USER = {"id": 1000000, "is_bot": True, "first_name": "Durak", "username": "fake_durak_bot"}
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def fake_result(method: str, data: dict, message_ids=itertools.count(1)):
+    """Builds a plausible Bot API result for the method"""
+    method = method.lower()
+    if method == "getme":
+        return BOT_USER
+    if method.startswith("send") or method.startswith("edit") or method == "copymessage":
+        message = {
+            "message_id": next(message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(data.get("chat_id", 0)), "type": "private"},
+            "from": BOT_USER,
+        }
+        if "text" in data:
+            message["text"] = data["text"]
+        if (markup := data.get("reply_markup")) is not None:
+            message["reply_markup"] = json.loads(markup) if isinstance(markup, str) else markup
+        return message
+    return True
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.calls: collections.Counter = collections.Counter()
+        self.last_call = time.monotonic()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+        self.calls[method] += 1
+        self.last_call = time.monotonic()
+        return web.json_response({"ok": True, "result": fake_result(method, data)})
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def wait_idle(self, quiet: float = 1.0) -> None:
+        while time.monotonic() - self.last_call < quiet:
+            await asyncio.sleep(quiet / 4)
+
+
+def user_dict(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"Игрок {user_id}", "username": f"player{user_id}"}
+
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    message = {"message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+               "from": user_dict(user_id), "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def callback_update(update_id: int, user_id: int, data: str) -> dict:
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": user_dict(user_id), "chat_instance": str(user_id), "data": data,
+        "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "text": "menu"}}}
+
+
+def synthetic_updates(users: int, seed: int = 0) -> list[dict]:
+    """Every user opens the menu, joins a queue and sends a few messages"""
+    rnd = random.Random(seed)
+    updates = []
+    counter = itertools.count(1)
+    for user_id in range(1, users + 1):
+        updates.append(message_update(next(counter), user_id, "/start"))
+        updates.append(callback_update(next(counter), user_id, rnd.choice(["queue_default", "queue_trans"])))
+        for _ in range(3):
+            updates.append(message_update(next(counter), user_id, rnd.choice(["6♠", "7♥", "10♦", "Туз ♣", "Взять", "Бито"])))
+    return updates
+
+
+async def wait_for_webhook(url: str) -> None:
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url):
+                    return
+            except aiohttp.ClientConnectionError:
+                await asyncio.sleep(0.5)
+
+
+async def post_updates(url: str, updates: list[dict], concurrency: int, secret: str | None) -> list[float]:
+    latencies = []
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    queue = collections.deque(updates)
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async def worker():
+            while queue:
+                update = queue.popleft()
+                started = time.perf_counter()
+                async with session.post(url, json=update) as response:
+                    await response.read()
+                latencies.append(time.perf_counter() - started)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+
+async def main(args) -> None:
+    if args.synthetic:
+        updates = synthetic_updates(args.synthetic)
+    else:
+        with open(args.updates, "r", encoding="utf-8") as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+
+    telegram = FakeTelegram()
+    runner = web.AppRunner(telegram.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.api_port).start()
+    print(f"Fake Bot API on http://127.0.0.1:{args.api_port}, waiting for the webhook at {args.webhook}")
+    await wait_for_webhook(args.webhook)
+    await telegram.wait_idle()
+    telegram.calls.clear()
+
+    started = time.monotonic()
+    latencies = await post_updates(args.webhook, updates, args.concurrency, args.secret)
+    posted = time.monotonic() - started
+    await telegram.wait_idle()
+
+    print(f"updates:          {len(updates)}")
+    print(f"posted in:        {posted:.2f} s ({len(updates) / posted:.0f} updates/s)")
+    print(f"post latency p50: {percentile(latencies, 50) * 1000:.1f} ms, p99: {percentile(latencies, 99) * 1000:.1f} ms")
+    print(f"api calls:        {sum(telegram.calls.values())} {dict(telegram.calls)}")
+    print(f"processed in:     {telegram.last_call - started:.2f} s")
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("updates", nargs="?", help="file with one recorded update per line")
+    parser.add_argument("--synthetic", type=int, metavar="USERS", help="generate updates for this many users instead")
+    parser.add_argument("--webhook", default="http://127.0.0.1:8080/webhook")
+    parser.add_argument("--secret")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+    if not args.updates and not args.synthetic:
+        parser.error("pass a file with updates or --synthetic")
+    asyncio.run(main(args))
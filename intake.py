@@ -0,0 +1,95 @@
+import asyncio
+import time
+from typing import Awaitable, Callable
+
+
+class UserIntake:
+    """Token bucket, last accepted text and the in-order lane of one user"""
+
+    __slots__ = ("tokens", "updated", "last_text", "last_time", "pending", "lane")
+
+    def __init__(self, capacity: float, now: float):
+        self.tokens = capacity
+        self.updated = now
+        self.last_text: str | None = None
+        self.last_time = 0.0
+        self.pending = 0
+        # asyncio.Lock wakes its waiters in order, so the messages of the user are handled one by one as they came
+        self.lane = asyncio.Lock()
+
+
+class Intake:
+    """
+    Admits the text messages of every user before they are handled: at most
+    `rate` per second with bursts of `burst`, the same text repeated within
+    `coalesce` seconds is dropped, and at most `backlog` messages of a user
+    wait to be handled. Dropped messages get no reply.
+    """
+
+    def __init__(self, rate: float = 5, burst: float = 10, coalesce: float = 1.0, backlog: int = 8):
+        self.rate = rate
+        self.burst = burst
+        self.coalesce = coalesce
+        self.backlog = backlog
+        self.users: dict[int, UserIntake] = {}
+        self.admitted = 0
+        self.throttled = 0
+        self.coalesced = 0
+        self.overflowed = 0
+        self._since_sweep = 0
+
+    def _admit(self, user_id: int, text: str) -> UserIntake | None:
+        now = time.monotonic()
+        if (user := self.users.get(user_id)) is None:
+            user = self.users[user_id] = UserIntake(self.burst, now)
+
+        if text == user.last_text and now - user.last_time < self.coalesce:
+            self.coalesced += 1
+            return None
+        user.tokens = min(self.burst, user.tokens + (now - user.updated) * self.rate)
+        user.updated = now
+        if user.tokens < 1:
+            self.throttled += 1
+            return None
+        if user.pending >= self.backlog:
+            self.overflowed += 1
+            return None
+
+        user.tokens -= 1
+        user.last_text = text
+        user.last_time = now
+        self.admitted += 1
+        return user
+
+    async def submit(self, user_id: int, text: str, handle: Callable[[], Awaitable]) -> bool:
+        """Handles the message after the earlier ones of the same user, returns False if it was dropped"""
+        self._since_sweep += 1
+        if self._since_sweep >= 1000:
+            self.sweep()
+        if (user := self._admit(user_id, text)) is None:
+            return False
+
+        user.pending += 1
+        try:
+            async with user.lane:
+                await handle()
+        finally:
+            user.pending -= 1
+        return True
+
+    def sweep(self) -> None:
+        """Forgets the users whose bucket has refilled and who have nothing to coalesce with"""
+        self._since_sweep = 0
+        now = time.monotonic()
+        idle = now - max(self.burst / self.rate, self.coalesce)
+        for user_id in [u for u, s in self.users.items() if not s.pending and s.updated <= idle and s.last_time <= idle]:
+            del self.users[user_id]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "users": len(self.users),
+            "admitted": self.admitted,
+            "throttled": self.throttled,
+            "coalesced": self.coalesced,
+            "overflowed": self.overflowed,
+        }
@@ -0,0 +1,118 @@
+import asyncio
+import enum
+import logging
+from typing import Callable
+
+import room
+import scheduler
+
+logger = logging.getLogger("bot")
+
+
+class State(enum.Enum):
+    SCHEDULED = "scheduled"
+    STARTING = "starting"
+    RUNNING = "running"
+    ENDING = "ending"
+    CLOSED = "closed"
+
+
+class RoomLifecycle:
+    """
+    Moves every room through scheduled → starting → running → ending → closed.
+    The loop of a running room is a supervised task, start and end have a timeout,
+    and whatever happens to one room, it ends up closed without touching the others.
+    """
+
+    def __init__(self, on_closed: Callable[[room.Room], None], start_timeout: float = 300, end_timeout: float = 300):
+        self.on_closed = on_closed
+        self.start_timeout = start_timeout
+        self.end_timeout = end_timeout
+        self.scheduler = scheduler.RoomScheduler(self.start, self.end)
+        self.states: dict[str, State] = {}
+        self.loops: dict[str, asyncio.Task] = {}
+
+    def state_of(self, r: room.Room) -> State:
+        return self.states.get(r.unique_id, State.CLOSED)
+
+    def count(self, state: State) -> int:
+        return sum(1 for s in self.states.values() if s is state)
+
+    def add(self, r: room.Room) -> None:
+        """Schedules a new room; a restored room that had started goes on running"""
+        self.scheduler.schedule(r)
+        if r.started:
+            self._run(r)
+        else:
+            self.states[r.unique_id] = State.SCHEDULED
+
+    def discard(self, r: room.Room) -> None:
+        """Closes a room that hasn't started"""
+        if self.state_of(r) is State.SCHEDULED:
+            self._close(r)
+
+    async def run(self) -> None:
+        await self.scheduler.run()
+
+    async def start(self, r: room.Room) -> None:
+        if self.state_of(r) is not State.SCHEDULED:
+            return
+        self.states[r.unique_id] = State.STARTING
+        try:
+            await asyncio.wait_for(r.start(), self.start_timeout)
+        except Exception:
+            # the event never began, so it isn't ended: the players don't get the messages about its end
+            logger.exception("Не удалось начать событие в комнате %s", r.unique_id, extra={"room": r.unique_id})
+            self._close(r)
+            await self._start_failed(r)
+            return
+
+        if r.started:
+            self._run(r)
+        else:
+            # the room has moved its start time
+            self.states[r.unique_id] = State.SCHEDULED
+            self.scheduler.schedule(r)
+
+    async def end(self, r: room.Room) -> None:
+        if self.state_of(r) in (State.ENDING, State.CLOSED):
+            return
+        self.states[r.unique_id] = State.ENDING
+        try:
+            await asyncio.wait_for(r.end(), self.end_timeout)
+        except Exception:
+            logger.exception("Ошибка при завершении события в комнате %s", r.unique_id, extra={"room": r.unique_id})
+        finally:
+            self._close(r)
+
+    async def _start_failed(self, r: room.Room) -> None:
+        try:
+            await r.send_message([r.admin], f"Не удалось начать событие в комнате {r.unique_id}, комната удалена.")
+        except Exception:
+            logger.exception("Не удалось сообщить администратору комнаты %s", r.unique_id, extra={"room": r.unique_id})
+
+    def _run(self, r: room.Room) -> None:
+        self.states[r.unique_id] = State.RUNNING
+        self.loops[r.unique_id] = asyncio.create_task(self._loop(r))
+
+    async def _loop(self, r: room.Room) -> None:
+        try:
+            await r.loop()
+        except Exception:
+            logger.exception("Ошибка в ходе события в комнате %s", r.unique_id, extra={"room": r.unique_id})
+            self.loops.pop(r.unique_id, None)
+            await self.end(r)
+            return
+
+        self.loops.pop(r.unique_id, None)
+        # a tournament that has found its winner closes before its end time
+        if self.state_of(r) is State.RUNNING:
+            self._close(r)
+
+    def _close(self, r: room.Room) -> None:
+        if (task := self.loops.pop(r.unique_id, None)) and task is not asyncio.current_task():
+            task.cancel()
+        self.scheduler.cancel(r)
+        self.states.pop(r.unique_id, None)
+        r.running = False
+        self.on_closed(r)
@@ -0,0 +1,303 @@
+"""
+Offline load test: drives bot.dp with synthetic updates against a stub Bot API.
+
+Players join the quick-match queues (and optionally marathon rooms) and then
+press the buttons of the last keyboard the bot sent them whenever it's their
+move. Each scenario runs in its own process so the numbers don't leak between runs.
+
+    python loadtest.py                          # 10, 100 and 1000 games
+    python loadtest.py --games 100 --save baseline.json
+    python loadtest.py --baseline baseline.json # exits with 1 on regression
+    python loadtest.py --rooms 2 --room-size 20 --max-handler-p99 500   # exits with 1 if handlers are slower
+    python loadtest.py --log-mode sync          # compare with logging on the event loop thread
+    python loadtest.py --memory 10000 --rooms 100 --room-size 50   # bytes per waiting user and per room
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import aiogram
+from aiogram import types
+from aiogram.utils import exceptions
+
+import fake_telegram
+
+
+class StubApi:
+    """
+    Replaces Bot.request: records every outgoing call, waits a random latency
+    and raises RetryAfter or BotBlocked like Telegram would
+    """
+
+    def __init__(self, rnd: random.Random, latency: float, retry_after: float, blocked: set[int]):
+        self.rnd = rnd
+        self.latency = latency
+        self.retry_after = retry_after
+        self.blocked = blocked
+        self.calls: list[str] = []
+        self.keyboards: dict[int, list[str]] = {}
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        data = data or {}
+        self.calls.append(method)
+        if self.latency:
+            await asyncio.sleep(self.rnd.uniform(0, 2 * self.latency))
+        chat_id = int(data.get("chat_id", 0))
+        if chat_id in self.blocked and method.startswith("send"):
+            raise exceptions.BotBlocked("Forbidden: bot was blocked by the user")
+        if self.retry_after and self.rnd.random() < self.retry_after:
+            raise exceptions.RetryAfter(1)
+
+        result = fake_telegram.fake_result(method, data)
+        if isinstance(result, dict) and (markup := result.get("reply_markup")):
+            if "keyboard" in markup:
+                self.keyboards[chat_id] = [b if isinstance(b, str) else b["text"] for row in markup["keyboard"] for b in row]
+            elif markup.get("remove_keyboard"):
+                self.keyboards.pop(chat_id, None)
+        return result
+
+
+def percentile(values: list[float], q: float) -> float:
+    return fake_telegram.percentile(values, q)
+
+
+async def run_scenario(games: int, rooms: int, room_size: int, duration: float, seed: int,
+                       latency: float, retry_after: float, blocked: float, log_mode: str = "queue") -> dict:
+    random.seed(seed)
+    rnd = random.Random(seed)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    import config
+    config.LOG_MODE = log_mode
+    import bot as app
+    import registry
+    import room
+    import stats
+    import supervisor
+
+    users = list(range(1, 2 * games + rooms * room_size + 1))
+    api = StubApi(rnd, latency, retry_after, {u for u in users if rnd.random() < blocked})
+    app.bot.request = api.request
+    stats.instrument(app.bot)
+    aiogram.Bot.set_current(app.bot)
+    aiogram.Dispatcher.set_current(app.dp)
+
+    update_ids = itertools.count(1)
+    latencies: list[float] = []
+    errors = 0
+
+    async def feed(update: dict) -> None:
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            await app.dp.process_update(types.Update(**update))
+        except Exception:  # the executor would only log it too
+            errors += 1
+        latencies.append(time.perf_counter() - started)
+
+    watcher = asyncio.create_task(stats.watch_loop(0.01))
+    matching = asyncio.create_task(app.matchmaking.run(app.start_table))
+    started = time.perf_counter()
+
+    # quick-match: every pair of users ends up in one game
+    queue_users = users[:2 * games]
+    for batch in range(0, len(queue_users), 100):
+        await asyncio.gather(*(feed(fake_telegram.callback_update(next(update_ids), u, rnd.choice(["queue_default", "queue_trans"])))
+                               for u in queue_users[batch:batch + 100]))
+        await asyncio.sleep(0)
+
+    # marathon rooms, joined through the invite deep link
+    admin = types.User(id=10 ** 9, is_bot=False, first_name="Admin")
+    for index in range(rooms):
+        r = room.Room(datetime.datetime.now(), None, None, room.Gamemode.MARATHON_DEFAULT, admin=admin, bot=app.bot)
+        app.add_room(r)
+        members = users[2 * games + index * room_size:2 * games + (index + 1) * room_size]
+        await asyncio.gather(*(feed(fake_telegram.message_update(next(update_ids), u, f"/start {r.payload}")) for u in members))
+        # the scheduler isn't running here, the room is started right away
+        await app.room_lifecycle.start(r)
+
+    # moves: whoever's turn it is presses a button of their last keyboard
+    deadline = time.monotonic() + duration
+    games_seen = set()
+    while time.monotonic() < deadline:
+        live = [g for g in list(supervisor.games.games) if g.running]
+        if not live and not any(r.running for r in registry.rooms):
+            break
+        games_seen.update(live)
+        moves = []
+        for g in live:
+            user_id = g.current_player.user.id
+            if buttons := api.keyboards.get(user_id):
+                moves.append(feed(fake_telegram.message_update(next(update_ids), user_id, rnd.choice(buttons))))
+        await asyncio.gather(*moves)
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+
+    for r in registry.rooms:
+        r.running = False
+    for g in list(supervisor.games.games):
+        g.running = False
+    if supervisor.games.tasks:
+        await asyncio.wait(supervisor.games.tasks, timeout=5)
+    watcher.cancel()
+    matching.cancel()
+
+    return {
+        "games": games,
+        "rooms": rooms,
+        "log_mode": log_mode,
+        "updates": len(latencies),
+        "handler_errors": errors,
+        "updates_per_second": len(latencies) / elapsed,
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p99_ms": percentile(latencies, 99) * 1000,
+        "loop_lag_p99_ms": stats.metrics.loop_lag.quantile(0.99) * 1000,
+        "loop_lag_max_ms": stats.metrics.loop_lag.max * 1000,
+        "match_wait_p50_s": app.matchmaking.stats()["wait_p50"],
+        "match_wait_p99_s": app.matchmaking.stats()["wait_p99"],
+        "intake_dropped": sum(v for k, v in app.user_intake.stats().items() if k not in ("users", "admitted")),
+        "api_calls": len(api.calls),
+        "api_calls_per_game": len(api.calls) / max(1, len(games_seen)),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_rss_growth_mb": (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024,
+        "elapsed_s": elapsed,
+    }
+
+
+async def measure_memory(waiting: int, rooms: int, room_size: int) -> dict:
+    """Memory the bot keeps per user waiting in a queue and per room full of players, measured with tracemalloc"""
+    import bot as app
+    import durak
+    import registry
+    import room
+
+    def user(user_id: int) -> types.User:
+        return types.User(id=user_id, is_bot=False, first_name=f"Player {user_id}", username=f"player{user_id}")
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for user_id in range(1, waiting + 1):
+        app.matchmaking.put(registry.UserRef.of(user(user_id)), "default")
+    queued = tracemalloc.take_snapshot()
+
+    admin = user(10 ** 9)
+    for index in range(rooms):
+        r = room.Room(datetime.datetime.now(), None, None, room.Gamemode.MARATHON_DEFAULT, admin=admin, bot=app.bot)
+        registry.rooms.add(r)
+        # what add_player_from_user keeps, without the join messages
+        for user_id in range(waiting + index * room_size + 1, waiting + (index + 1) * room_size + 1):
+            u = user(user_id)
+            r._add(player := durak.Player(u))
+            r.scoreboard.add(player)
+            registry.users.add_room_player(r, u)
+        r.everyone
+    filled = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    def grown(old: tracemalloc.Snapshot, new: tracemalloc.Snapshot) -> int:
+        return sum(stat.size_diff for stat in new.compare_to(old, "filename"))
+
+    return {
+        "waiting": waiting,
+        "rooms": rooms,
+        "room_size": room_size,
+        "bytes_per_waiting_user": grown(before, queued) / max(1, waiting),
+        "bytes_per_room": grown(queued, filled) / max(1, rooms),
+        "bytes_per_room_player": grown(queued, filled) / max(1, rooms * room_size),
+    }
+
+
+# metric -> True if bigger is better
+GATED_METRICS = {"latency_p99_ms": False, "updates_per_second": True, "api_calls_per_game": False, "peak_rss_growth_mb": False}
+
+
+def regressions(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    found = []
+    for metric, higher_is_better in GATED_METRICS.items():
+        old, new = baseline[metric], result[metric]
+        if higher_is_better and new < old * (1 - tolerance) or not higher_is_better and new > old * (1 + tolerance):
+            found.append(f"{metric}: {old:.2f} -> {new:.2f}")
+    return found
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--games", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--rooms", type=int, default=0, help="marathon rooms per scenario")
+    parser.add_argument("--room-size", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=30, help="seconds of play per scenario")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.05, help="mean Bot API latency, seconds")
+    parser.add_argument("--retry-after", type=float, default=0.001, help="probability of a flood-wait per call")
+    parser.add_argument("--blocked", type=float, default=0.01, help="share of users who blocked the bot")
+    parser.add_argument("--log-mode", choices=["sync", "queue", "json"], default="queue",
+                        help="sync is the file handler on the event loop thread")
+    parser.add_argument("--memory", type=int, metavar="USERS",
+                        help="only measure the memory of USERS queued users and of --rooms rooms of --room-size players")
+    parser.add_argument("--save", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare with results saved earlier")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--max-handler-p99", type=float, default=1000, metavar="MS",
+                        help="fail if the p99 time to handle an update is longer, e.g. a handler waiting on a chat's rate limit")
+    parser.add_argument("--scenario", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.memory is not None:
+        result = asyncio.run(measure_memory(args.memory, args.rooms, args.room_size))
+        print(f"{result['bytes_per_waiting_user']:.0f} bytes per waiting user, {result['bytes_per_room']:.0f} bytes per room "
+              f"of {args.room_size} ({result['bytes_per_room_player']:.0f} per player)")
+        if args.save:
+            with open(args.save, "w", encoding="utf-8") as f:
+                json.dump(result, f, indent=2)
+        return 0
+
+    if args.scenario is not None:
+        result = asyncio.run(run_scenario(args.scenario, args.rooms, args.room_size, args.duration, args.seed,
+                                          args.latency, args.retry_after, args.blocked, args.log_mode))
+        print(json.dumps(result))
+        return 0
+
+    results = {}
+    failed = False
+    for games in args.games:
+        child = subprocess.run([sys.executable, __file__, "--scenario", str(games), *sys.argv[1:]],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if child.returncode:
+            # stderr also carries the console log of the bot, the traceback is at its end
+            tail = "\n".join(child.stderr.splitlines()[-50:])
+            print(f"N={games}: the run failed with exit code {child.returncode}\n{tail}", file=sys.stderr)
+            return 1
+        results[str(games)] = result = json.loads(child.stdout.strip().splitlines()[-1])
+        print(f"N={games:>5}: {result['updates']} updates ({result['handler_errors']} failed), {result['updates_per_second']:.0f} upd/s, "
+              f"p50 {result['latency_p50_ms']:.1f} ms, p99 {result['latency_p99_ms']:.1f} ms, "
+              f"loop lag p99 {result['loop_lag_p99_ms']:.1f} ms, "
+              f"{result['api_calls_per_game']:.1f} calls/game, peak RSS {result['peak_rss_mb']:.0f} MB "
+              f"(+{result['peak_rss_growth_mb']:.0f} MB)")
+        if result['latency_p99_ms'] > args.max_handler_p99:
+            failed = True
+            print(f"N={games}: handler p99 {result['latency_p99_ms']:.0f} ms is over {args.max_handler_p99:.0f} ms")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        for games, result in results.items():
+            if games in baseline and (found := regressions(result, baseline[games], args.tolerance)):
+                failed = True
+                print(f"N={games} regressed: " + "; ".join(found))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
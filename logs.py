@@ -0,0 +1,56 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+PLAIN_FORMAT = "[%(asctime)s] %(message)s"
+
+# "sync" writes on the calling thread like before, "queue" and "json" hand the records to a background thread
+MODES = ("sync", "queue", "json")
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records into the queue as they are, so the message is formatted by the
+    listener thread. Arguments of the log calls must not be changed afterwards.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the room and game ids passed in `extra`"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": self.formatTime(record), "level": record.levelname, "message": record.getMessage()}
+        for key in ("room", "game"):
+            if (value := getattr(record, key, None)) is not None:
+                entry[key] = str(value)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup(logger: logging.Logger, path: str, mode: str = "queue") -> None:
+    if mode not in MODES:
+        raise ValueError(f"Unknown log mode {mode!r}, expected one of {MODES}")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    file_handler = logging.handlers.TimedRotatingFileHandler(path, encoding="utf-8", when="midnight")
+    file_handler.setFormatter(JsonFormatter() if mode == "json" else logging.Formatter(PLAIN_FORMAT))
+
+    if mode == "sync":
+        logger.addHandler(file_handler)
+        return
+
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    records = queue.SimpleQueue()
+    logger.addHandler(DeferredQueueHandler(records))
+    # the console output of the root logger moves to the listener thread as well
+    logger.propagate = False
+    listener = logging.handlers.QueueListener(records, file_handler, console, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
@@ -0,0 +1,312 @@
+import asyncio
+import bisect
+import collections
+import contextlib
+import itertools
+import time
+from typing import Callable
+
+import durak
+import persistence
+import registry
+
+
+class MarathonMatchmaker:
+    """
+    Pairs marathon players as soon as two of them are waiting. Players are taken
+    in order of arrival; since every player has at most one previous opponent to
+    avoid, a partner is always found among the first waiting players.
+    """
+
+    def __init__(self, rematch_allowed: Callable[[], bool]):
+        self.rematch_allowed = rematch_allowed
+        self.waiting: dict[int, tuple[durak.Player, float]] = {}
+        self.wakeup = asyncio.Event()
+        self.closed = False
+
+        self.pairs = 0
+        self.waits: collections.deque[float] = collections.deque(maxlen=1000)
+        self.longest_wait = 0.0
+
+    def put(self, player: durak.Player) -> None:
+        self.waiting[player.user.id] = (player, time.monotonic())
+        self.wakeup.set()
+
+    def discard(self, user_id: int) -> None:
+        self.waiting.pop(user_id, None)
+
+    def close(self) -> None:
+        self.closed = True
+        self.wakeup.set()
+
+    def _can_play(self, p1: durak.Player, p2: durak.Player) -> bool:
+        return (p1.previously_played_with is not p2 and p2.previously_played_with is not p1) or self.rematch_allowed()
+
+    def match(self) -> list[tuple[durak.Player, durak.Player]]:
+        pairs = []
+        # players who couldn't be paired with anyone before them, holds two players at most
+        unpaired: list[tuple[durak.Player, float]] = []
+        now = time.monotonic()
+        for entry in self.waiting.values():
+            for other in unpaired:
+                if self._can_play(other[0], entry[0]):
+                    unpaired.remove(other)
+                    pairs.append((other[0], entry[0]))
+                    for _, since in (other, entry):
+                        self.waits.append(now - since)
+                        self.longest_wait = max(self.longest_wait, now - since)
+                    break
+            else:
+                unpaired.append(entry)
+
+        for p1, p2 in pairs:
+            del self.waiting[p1.user.id]
+            del self.waiting[p2.user.id]
+        self.pairs += len(pairs)
+        return pairs
+
+    async def run(self, start_game: Callable[[durak.Player, durak.Player], None]) -> None:
+        while not self.closed:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            if self.closed:
+                break
+            for p1, p2 in self.match():
+                start_game(p1, p2)
+
+    def stats(self) -> dict[str, float]:
+        waits = sorted(self.waits)
+        now = time.monotonic()
+        return {
+            "waiting": len(self.waiting),
+            "pairs": self.pairs,
+            "wait_mean": sum(waits) / len(waits) if waits else 0.0,
+            "wait_p50": waits[len(waits) // 2] if waits else 0.0,
+            "wait_p95": waits[int(len(waits) * 0.95)] if waits else 0.0,
+            "wait_max": self.longest_wait,
+            "waiting_longest": max((now - since for _, since in self.waiting.values()), default=0.0),
+        }
+
+
+class Ratings:
+    """Elo ratings of quick-match players, kept in the state store"""
+
+    DEFAULT = 1000.0
+    K = 32
+
+    def __init__(self):
+        self.values: dict[int, float] = {}
+
+    def restore(self) -> None:
+        self.values = {int(user_id): rating for user_id, rating in persistence.backend.load("rating").items()}
+
+    def get(self, user_id: int) -> float:
+        return self.values.get(user_id, self.DEFAULT)
+
+    def record(self, user_ids: list[int], winner_id: int | None) -> None:
+        """The winner takes points from every other player of the table, a draw changes nothing"""
+        if winner_id is None or winner_id not in user_ids or len(user_ids) < 2:
+            return
+        k = self.K / (len(user_ids) - 1)
+        winner = self.get(winner_id)
+        gained = 0.0
+        for user_id in user_ids:
+            if user_id == winner_id:
+                continue
+            loser = self.get(user_id)
+            delta = k * (1 - 1 / (1 + 10 ** ((loser - winner) / 400)))
+            gained += delta
+            self.values[user_id] = loser - delta
+            persistence.backend.save("rating", str(user_id), self.values[user_id])
+        self.values[winner_id] = winner + gained
+        persistence.backend.save("rating", str(winner_id), self.values[winner_id])
+
+
+class Ticket:
+    __slots__ = ("user", "rating", "seq", "since", "pools")
+
+    def __init__(self, user: registry.UserRef, rating: float, seq: int, since: float):
+        self.user = user
+        self.rating = rating
+        self.seq = seq
+        self.since = since
+        self.pools: list["Pool"] = []
+
+
+class Pool:
+    """Users waiting for one variant and table size, sorted by rating and by arrival"""
+
+    __slots__ = ("variant", "size", "order", "tickets")
+
+    def __init__(self, variant: str, size: int):
+        self.variant = variant
+        self.size = size
+        # (rating, seq) sorted. Insertion and removal are O(n): the binary search is O(log n), but the list
+        # shifts its tail with a memmove of pointers, which stays in microseconds for queues of thousands
+        self.order: list[tuple[float, int]] = []
+        self.tickets: dict[int, Ticket] = {}
+
+    def __len__(self) -> int:
+        return len(self.tickets)
+
+    def add(self, ticket: Ticket) -> None:
+        bisect.insort(self.order, (ticket.rating, ticket.seq))
+        self.tickets[ticket.seq] = ticket
+
+    def remove(self, ticket: Ticket) -> None:
+        del self.order[bisect.bisect_left(self.order, (ticket.rating, ticket.seq))]
+        del self.tickets[ticket.seq]
+
+    def table_for(self, anchor: Ticket, window: float) -> list[Ticket] | None:
+        """The anchor and the players closest to them by rating, if all of them are within the window"""
+        index = bisect.bisect_left(self.order, (anchor.rating, anchor.seq))
+        table = [anchor]
+        left, right = index - 1, index + 1
+        while len(table) < self.size:
+            below = anchor.rating - self.order[left][0] if left >= 0 else None
+            above = self.order[right][0] - anchor.rating if right < len(self.order) else None
+            if below is not None and (above is None or below <= above):
+                distance, seq = below, self.order[left][1]
+                left -= 1
+            elif above is not None:
+                distance, seq = above, self.order[right][1]
+                right += 1
+            else:
+                return None
+            if distance > window:
+                return None
+            table.append(self.tickets[seq])
+        return table
+
+
+class QueueMatchmaker:
+    """
+    Quick-match queues of both variants. Users are seated at tables of 2 to 6
+    players with a similar rating: the allowed rating difference starts at
+    `window` and grows by `growth` every second of waiting. A user may wait in
+    both variants at once and leaves both when a table is found for them.
+    Users are tried in order of arrival, so the longest waiting get their table first.
+    """
+
+    def __init__(self, ratings: Ratings, window: float = 100, growth: float = 10, interval: float = 1.0):
+        self.ratings = ratings
+        self.window = window
+        self.growth = growth
+        self.interval = interval
+        self.tickets: dict[int, Ticket] = {}
+        self.pools: dict[tuple[str, int], Pool] = {}
+        # tickets that haven't been tried as an anchor yet
+        self.fresh: list[Ticket] = []
+        self.seq = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.closed = False
+
+        self.tables = 0
+        self.waits: collections.deque[float] = collections.deque(maxlen=1000)
+        self.longest_wait = 0.0
+
+    def length(self, variant: str) -> int:
+        return sum(len(p) for (v, _), p in self.pools.items() if v == variant)
+
+    def queued(self, user_id: int, variant: str) -> bool:
+        ticket = self.tickets.get(user_id)
+        return ticket is not None and any(p.variant == variant for p in ticket.pools)
+
+    def put(self, user: registry.UserRef, variant: str, size: int = 2, since: float | None = None) -> bool:
+        """Queues the user for the variant, returns False if they already wait for it"""
+        if self.queued(user.id, variant):
+            return False
+        if since is None:
+            since = time.time()
+            persistence.backend.save("queue", f"{variant}:{user.id}", (since, user.to_python(), size))
+        if (ticket := self.tickets.get(user.id)) is None:
+            ticket = self.tickets[user.id] = Ticket(user, self.ratings.get(user.id), next(self.seq),
+                                                    time.monotonic() - max(0.0, time.time() - since))
+        if (pool := self.pools.get((variant, size))) is None:
+            pool = self.pools[variant, size] = Pool(variant, size)
+        pool.add(ticket)
+        ticket.pools.append(pool)
+        self.fresh.append(ticket)
+        self.wakeup.set()
+        return True
+
+    def discard(self, user_id: int, variant: str | None = None) -> bool:
+        """Takes the user out of the variant's queue, or out of every queue"""
+        if (ticket := self.tickets.get(user_id)) is None:
+            return False
+        left = [p for p in ticket.pools if variant is None or p.variant == variant]
+        for pool in left:
+            pool.remove(ticket)
+            ticket.pools.remove(pool)
+            persistence.backend.delete("queue", f"{pool.variant}:{user_id}")
+        if not ticket.pools:
+            del self.tickets[user_id]
+        return bool(left)
+
+    def restore(self) -> None:
+        for key, entry in sorted(persistence.backend.load("queue").items(), key=lambda item: item[1][0]):
+            variant = key.partition(":")[0]
+            # entries saved before table sizes existed hold no size
+            size = entry[2] if len(entry) > 2 else 2
+            self.put(registry.UserRef.from_python(entry[1]), variant, size, since=entry[0])
+
+    def window_of(self, ticket: Ticket, now: float) -> float:
+        return self.window + self.growth * (now - ticket.since)
+
+    def match(self, everyone: bool = True) -> list[tuple[str, list[registry.UserRef]]]:
+        """
+        Seats whoever can be seated. Without `everyone` only the users queued
+        since the last call are tried as anchors; windows of the others only
+        change with time and are tried on the periodic pass.
+        """
+        now = time.monotonic()
+        anchors = list(self.tickets.values()) if everyone else self.fresh
+        self.fresh = []
+        tables = []
+        for anchor in anchors:
+            if self.tickets.get(anchor.user.id) is not anchor:
+                continue
+            for pool in anchor.pools:
+                if table := pool.table_for(anchor, self.window_of(anchor, now)):
+                    break
+            else:
+                continue
+            for ticket in table:
+                self.discard(ticket.user.id)
+                self.waits.append(now - ticket.since)
+                self.longest_wait = max(self.longest_wait, now - ticket.since)
+            tables.append((pool.variant, [t.user for t in table]))
+        self.tables += len(tables)
+        return tables
+
+    def close(self) -> None:
+        self.closed = True
+        self.wakeup.set()
+
+    async def run(self, start_table: Callable[[str, list[registry.UserRef]], None]) -> None:
+        deadline = time.monotonic() + self.interval
+        while not self.closed:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.wakeup.wait(), max(0.0, deadline - time.monotonic()))
+            self.wakeup.clear()
+            if self.closed:
+                break
+            periodic = time.monotonic() >= deadline
+            if periodic:
+                deadline = time.monotonic() + self.interval
+            for variant, users in self.match(everyone=periodic):
+                start_table(variant, users)
+
+    def stats(self) -> dict[str, float]:
+        waits = sorted(self.waits)
+        now = time.monotonic()
+        return {
+            "waiting": len(self.tickets),
+            "tables": self.tables,
+            "wait_mean": sum(waits) / len(waits) if waits else 0.0,
+            "wait_p50": waits[len(waits) // 2] if waits else 0.0,
+            "wait_p95": waits[int(len(waits) * 0.95)] if waits else 0.0,
+            "wait_p99": waits[int(len(waits) * 0.99)] if waits else 0.0,
+            "wait_max": self.longest_wait,
+            "waiting_longest": max((now - t.since for t in self.tickets.values()), default=0.0),
+        }
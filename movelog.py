@@ -0,0 +1,339 @@
+"""
+Append-only binary log of every game: the deal seed, the players and each move.
+
+A log is enough to rebuild a game by replaying its moves, either to resume a
+quick-match game after a crash or to re-run recorded games offline:
+    python movelog.py movelog/             # replays every finished game
+
+Finished logs are moved to the archive/ subdirectory, so a restart only reads
+the logs of the games that were running.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import os
+import random
+import struct
+import sys
+import time
+from types import coroutine
+
+import aiogram
+from aiogram import types
+
+import config
+import durak
+import fake_telegram
+
+MAGIC = b"DRKL"
+VERSION = 1
+
+HEADER = struct.Struct("<4sBQBHB")  # magic, version, seed, flags, move time, players
+PLAYER = struct.Struct("<qBB")  # user id, length of first name, length of username
+MOVE = struct.Struct("<BBIH")  # tag, player index, ms since start, length of text
+END = struct.Struct("<BBI")  # tag, winner index, ms since start
+
+TAG_MOVE = 1
+TAG_END = 2
+
+FLAG_TRANSFERRABLE = 1
+FLAG_ROOM = 2
+
+DRAW = 255
+ABORTED = 254
+
+ARCHIVE = "archive"
+
+# deal seeds come from their own generator, the global one is never left seeded with a logged seed
+_seeds = random.Random()
+
+
+@contextlib.contextmanager
+def seeded(seed: int):
+    """random follows the seed inside the block, afterwards it is back where it was"""
+    state = random.getstate()
+    random.seed(seed)
+    try:
+        yield
+    finally:
+        random.setstate(state)
+
+
+@coroutine
+def _seeded_first_step(awaitable, seed: int):
+    it = awaitable.__await__()
+    with seeded(seed):
+        try:
+            request = next(it)
+        except StopIteration as stop:
+            return stop.value
+    # the rest is passed through as it is, cancellation goes on into the game loop
+    while True:
+        reply, error = None, None
+        try:
+            reply = yield request
+        except BaseException as exc:  # pylint: disable=broad-except
+            error = exc
+        try:
+            request = it.throw(error) if error is not None else it.send(reply)
+        except StopIteration as stop:
+            return stop.value
+
+
+async def play_seeded(game_loop, seed: int):
+    """
+    Awaits the game loop with random seeded for its first step, up to its first
+    await: that's where the cards are dealt. Other games and rooms running at
+    the same time keep their own random state.
+    """
+    return await _seeded_first_step(game_loop, seed)
+
+
+class OfflineBot(aiogram.Bot):
+    """Bot that never talks to Telegram, used to replay games"""
+
+    def __init__(self):
+        super().__init__("1:offline")
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        return fake_telegram.fake_result(method, data or {})
+
+
+class GameLog:
+    def __init__(self, seed: int, flags: int, move_time: int, players: list[types.User]):
+        self.seed = seed
+        self.flags = flags
+        self.move_time = move_time
+        self.players = players
+        self.moves: list[tuple[int, int, str]] = []
+        self.result: int | None = None
+        self.duration = 0
+
+    @property
+    def is_transferrable(self) -> bool:
+        return bool(self.flags & FLAG_TRANSFERRABLE)
+
+    @property
+    def finished(self) -> bool:
+        return self.result is not None
+
+
+def read(path: str) -> GameLog:
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, seed, flags, move_time, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a game log")
+    offset = HEADER.size
+
+    players = []
+    for _ in range(count):
+        user_id, name_len, username_len = PLAYER.unpack_from(data, offset)
+        offset += PLAYER.size
+        name = data[offset:offset + name_len].decode()
+        username = data[offset + name_len:offset + name_len + username_len].decode() or None
+        offset += name_len + username_len
+        players.append(types.User(id=user_id, is_bot=False, first_name=name, username=username))
+    log = GameLog(seed, flags, move_time, players)
+
+    # a crash can leave a truncated record at the end, it is ignored
+    while offset < len(data):
+        if data[offset] == TAG_MOVE and offset + MOVE.size <= len(data):
+            _, index, ms, length = MOVE.unpack_from(data, offset)
+            if offset + MOVE.size + length > len(data):
+                break
+            text = data[offset + MOVE.size:offset + MOVE.size + length].decode()
+            log.moves.append((index, ms, text))
+            offset += MOVE.size + length
+        elif data[offset] == TAG_END and offset + END.size <= len(data):
+            _, log.result, log.duration = END.unpack_from(data, offset)
+            offset += END.size
+        else:
+            break
+    return log
+
+
+class Journal:
+    """
+    Writes the logs of running games. Records are encoded on the event loop and
+    appended by a single background thread, so their order is kept
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.archive = os.path.join(directory, ARCHIVE)
+        os.makedirs(self.archive, exist_ok=True)
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="movelog")
+        self.files = {}
+        # game -> (path, seed, monotonic start, user id -> player index)
+        self.games: dict[durak.Game, tuple[str, int, float, dict[int, int]]] = {}
+
+    def _append(self, path: str, data: bytes, last: bool = False) -> None:
+        if (f := self.files.get(path)) is None:
+            f = self.files[path] = open(path, "ab")
+        f.write(data)
+        f.flush()
+        if last:
+            f.close()
+            del self.files[path]
+            os.replace(path, os.path.join(self.archive, os.path.basename(path)))
+
+    def create_game(self, players: list[durak.Player], bot, is_transferrable: bool, in_room: bool = False) -> durak.Game:
+        seed = _seeds.getrandbits(63)
+        with seeded(seed):
+            game = durak.Game(players, bot=bot, move_time=config.SECONDS_FOR_MOVE, is_transferrable=is_transferrable)
+
+        flags = (FLAG_TRANSFERRABLE if is_transferrable else 0) | (FLAG_ROOM if in_room else 0)
+        header = [HEADER.pack(MAGIC, VERSION, seed, flags, config.SECONDS_FOR_MOVE, len(players))]
+        for p in players:
+            name, username = (p.user.first_name or "").encode(), (p.user.username or "").encode()
+            header.append(PLAYER.pack(p.user.id, len(name), len(username)) + name + username)
+
+        path = os.path.join(self.directory, f"{game.unique_id}.bin")
+        self.games[game] = (path, seed, time.monotonic(), {p.user.id: i for i, p in enumerate(players)})
+        self.writer.submit(self._append, path, b"".join(header))
+        return game
+
+    def adopt(self, game: durak.Game, path: str, log: GameLog) -> None:
+        """Continues the log of a game rebuilt from it"""
+        index = {u.id: i for i, u in enumerate(log.players)}
+        elapsed = log.moves[-1][1] / 1000 if log.moves else 0
+        self.games[game] = (path, log.seed, time.monotonic() - elapsed, index)
+
+    async def play(self, game: durak.Game):
+        """Runs the game loop, the deal follows the logged seed so it can be repeated"""
+        if (entry := self.games.get(game)) is None:
+            return await game.game_loop()
+        return await play_seeded(game.game_loop(), entry[1])
+
+    def move(self, game: durak.Game, user_id: int, text: str) -> None:
+        if (entry := self.games.get(game)) is None:
+            return
+        path, _, started, index = entry
+        data = text.encode()[:0xFFFF]
+        ms = int((time.monotonic() - started) * 1000)
+        self.writer.submit(self._append, path, MOVE.pack(TAG_MOVE, index[user_id], ms, len(data)) + data)
+
+    def finish(self, game: durak.Game, winner: durak.Player | str | None) -> None:
+        if (entry := self.games.pop(game, None)) is None:
+            return
+        path, _, started, index = entry
+        if winner is None:
+            result = ABORTED
+        elif winner == "draw":
+            result = DRAW
+        else:
+            result = index[winner.user.id]
+        self.writer.submit(self._append, path, END.pack(TAG_END, result, int((time.monotonic() - started) * 1000)), True)
+
+    def unfinished(self) -> list[str]:
+        """Finished logs are in the archive, so only the games that were running when the bot stopped are read"""
+        paths = (os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".bin"))
+        unfinished = []
+        for path in paths:
+            if read(path).finished:
+                # written before finished logs were archived
+                os.replace(path, os.path.join(self.archive, os.path.basename(path)))
+            else:
+                unfinished.append(path)
+        return unfinished
+
+    def abort(self, path: str) -> None:
+        self.writer.submit(self._append, path, END.pack(TAG_END, ABORTED, 0), True)
+
+    def close(self) -> None:
+        # games still running stay unfinished in the log, they are resumed after the restart
+        self.games.clear()
+        self.writer.shutdown(wait=True)
+
+
+class NullJournal(Journal):
+    """Used when MOVE_LOG_DIR is not set: games are created as usual and nothing is written"""
+
+    def __init__(self):  # pylint: disable=super-init-not-called
+        self.games = {}
+
+    def create_game(self, players, bot, is_transferrable, in_room=False):
+        return durak.Game(players, bot=bot, move_time=config.SECONDS_FOR_MOVE, is_transferrable=is_transferrable)
+
+    def move(self, game, user_id, text):
+        pass
+
+    def finish(self, game, winner):
+        pass
+
+    def unfinished(self):
+        return []
+
+    def close(self):
+        pass
+
+
+journal = Journal(path) if (path := getattr(config, "MOVE_LOG_DIR", None)) else NullJournal()
+
+
+async def replay(log: GameLog, bot: aiogram.Bot, move_time: int | None = None) -> tuple[durak.Game, asyncio.Task, bool]:
+    """
+    Rebuilds the game and feeds it the logged moves; returns it with its running game loop
+    and whether it followed the log. It doesn't if a logged player never gets the turn or
+    the game ends before the last move, e.g. after a move timeout, which isn't logged
+    """
+    aiogram.Bot.set_current(bot)
+    with seeded(log.seed):
+        game = durak.Game([durak.Player(u) for u in log.players], bot=bot, move_time=move_time or log.move_time,
+                          is_transferrable=log.is_transferrable)
+    task = asyncio.ensure_future(play_seeded(game.game_loop(), log.seed))
+
+    for number, (index, _, text) in enumerate(log.moves):
+        user = log.players[index]
+        # wait until the game asks this player for a move, as it did when the move was made
+        for _ in range(1000):
+            if task.done() or (game.running and game.current_player.user.id == user.id):
+                break
+            await asyncio.sleep(0)
+        if task.done() or not (game.running and game.current_player.user.id == user.id):
+            return game, task, False
+        message = types.Message(**{"message_id": number + 1, "date": int(time.time()), "text": text,
+                                   "chat": {"id": user.id, "type": "private"}, "from": user.to_python()})
+        await game.move_handler(message)
+    return game, task, True
+
+
+async def replay_all(directory: str, limit: int | None) -> int:
+    directories = [directory] + ([archive] if os.path.isdir(archive := os.path.join(directory, ARCHIVE)) else [])
+    paths = sorted(os.path.join(d, name) for d in directories for name in os.listdir(d) if name.endswith(".bin"))
+    logs = [log for log in map(read, paths) if log.finished and log.result != ABORTED][:limit]
+    bot = OfflineBot()
+
+    mismatches = 0
+    moves = sum(len(log.moves) for log in logs)
+    started = time.perf_counter()
+    for log in logs:
+        _, task, in_sync = await replay(log, bot, move_time=10 ** 6)
+        try:
+            winner = await asyncio.wait_for(task, timeout=1)
+        except asyncio.TimeoutError:
+            # the logged game ended on a move timeout, which a replay at full speed can't repeat
+            winner = None
+        if winner is None:
+            result = ABORTED
+        else:
+            result = DRAW if winner == "draw" else [u.id for u in log.players].index(winner.user.id)
+        if not in_sync or result != log.result:
+            mismatches += 1
+    elapsed = time.perf_counter() - started
+    await (await bot.get_session()).close()
+
+    print(f"replayed {len(logs)} games, {moves} moves in {elapsed:.2f} s "
+          f"({len(logs) / elapsed:.0f} games/s, {moves / elapsed:.0f} moves/s)")
+    print(f"results differing from the log: {mismatches}")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", nargs="?", default=getattr(config, "MOVE_LOG_DIR", None) or "movelog")
+    parser.add_argument("--limit", type=int)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(replay_all(args.directory, args.limit)))
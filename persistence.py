@@ -0,0 +1,138 @@
+import copy
+import logging
+import pickle
+import queue
+import sqlite3
+import threading
+import time
+import typing
+
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+logger = logging.getLogger("bot")
+
+
+class Store:
+    """Key-value storage for state that has to survive a restart. Does nothing by itself"""
+
+    def save(self, kind: str, key: str, value: typing.Any) -> None:
+        pass
+
+    def delete(self, kind: str, key: str) -> None:
+        pass
+
+    def load(self, kind: str) -> dict[str, typing.Any]:
+        return {}
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteStore(Store):
+    """
+    Keeps the state in an SQLite database in WAL mode. save() and delete() only
+    queue the change; a background thread pickles the values and commits them in
+    batches, keeping only the latest write of every key.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 0.5):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.queue: queue.Queue = queue.Queue()
+
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS state (kind TEXT, key TEXT, value BLOB, PRIMARY KEY (kind, key))")
+        self.thread = threading.Thread(target=self._writer, name="state-writer", daemon=True)
+        self.thread.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def save(self, kind: str, key: str, value: typing.Any) -> None:
+        self.queue.put((kind, key, value))
+
+    def delete(self, kind: str, key: str) -> None:
+        self.queue.put((kind, key, None))
+
+    def load(self, kind: str) -> dict[str, typing.Any]:
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT key, value FROM state WHERE kind = ?", (kind,)).fetchall()
+        finally:
+            conn.close()
+        return {key: pickle.loads(value) for key, value in rows}
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+
+    def _writer(self) -> None:
+        conn = self._connect()
+        closing = False
+        while not closing:
+            item = self.queue.get()
+            batch = {}
+            deadline = time.monotonic() + self.flush_interval
+            while item is not None:
+                batch[item[:2]] = item[2]
+                if (remaining := deadline - time.monotonic()) <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            closing = item is None
+
+            try:
+                with conn:
+                    for (kind, key), value in batch.items():
+                        if value is None:
+                            conn.execute("DELETE FROM state WHERE kind = ? AND key = ?", (kind, key))
+                        else:
+                            conn.execute("INSERT OR REPLACE INTO state VALUES (?, ?, ?)",
+                                         (kind, key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+            except sqlite3.Error:
+                logger.exception("Не удалось сохранить %s изменений состояния", len(batch))
+        conn.close()
+
+
+class PersistentMemoryStorage(MemoryStorage):
+    """FSM storage that lives in memory and mirrors every change into a Store"""
+
+    def __init__(self, store: Store):
+        super().__init__()
+        self.store = store
+        for key, value in store.load("fsm").items():
+            chat, user = key.split(":")
+            self.data.setdefault(chat, {})[user] = {"state": value["state"], "data": value["data"], "bucket": {}}
+
+    def _persist(self, chat, user) -> None:
+        chat, user = map(str, self.check_address(chat=chat, user=user))
+        entry = self.data.get(chat, {}).get(user)
+        if entry is None or (entry["state"] is None and not entry["data"]):
+            self.store.delete("fsm", f"{chat}:{user}")
+        else:
+            self.store.save("fsm", f"{chat}:{user}", {"state": entry["state"], "data": copy.deepcopy(entry["data"])})
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        await super().set_state(chat=chat, user=user, state=state)
+        self._persist(chat, user)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        await super().set_data(chat=chat, user=user, data=data)
+        self._persist(chat, user)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        await super().update_data(chat=chat, user=user, data=data, **kwargs)
+        self._persist(chat, user)
+
+
+backend: Store = Store()
+
+
+def use(store: Store) -> None:
+    global backend
+    backend = store
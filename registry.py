@@ -0,0 +1,151 @@
+from typing import TYPE_CHECKING, Callable
+
+from aiogram import types
+
+import durak
+
+if TYPE_CHECKING:
+    import room
+
+
+class UserRef:
+    """What the bot keeps of a user who waits somewhere: id and the names for mentions"""
+
+    __slots__ = ("id", "first_name", "last_name", "username")
+
+    def __init__(self, id: int, first_name: str = "", last_name: str | None = None, username: str | None = None):
+        self.id = id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.username = username
+
+    @classmethod
+    def of(cls, user: "types.User | UserRef") -> "UserRef":
+        if isinstance(user, UserRef):
+            return user
+        return cls(user.id, user.first_name, user.last_name, user.username)
+
+    @classmethod
+    def from_python(cls, data: dict) -> "UserRef":
+        return cls(data["id"], data.get("first_name", ""), data.get("last_name"), data.get("username"))
+
+    @property
+    def full_name(self) -> str:
+        if self.last_name:
+            return f"{self.first_name} {self.last_name}"
+        return self.first_name
+
+    @property
+    def mention(self) -> str:
+        return f"@{self.username}" if self.username else self.full_name
+
+    def to_python(self) -> dict:
+        result = {"id": self.id, "is_bot": False, "first_name": self.first_name}
+        if self.last_name:
+            result["last_name"] = self.last_name
+        if self.username:
+            result["username"] = self.username
+        return result
+
+    def to_user(self) -> types.User:
+        return types.User(**self.to_python())
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, (UserRef, types.User)) and self.id == other.id
+
+    def __hash__(self) -> int:
+        return hash(self.id)
+
+    def __repr__(self) -> str:
+        return f"UserRef({self.id}, {self.mention!r})"
+
+
+class UserRegistry:
+    """Index of where every user currently is: game and room"""
+
+    def __init__(self):
+        self.games: dict[int, durak.Game] = {}
+        self.rooms: dict[int, "room.Room"] = {}
+        # "@username" -> user id of room players; full names aren't unique, so they aren't indexed
+        self.mentions: dict[str, int] = {}
+        # called with the user and whether they are in a game or a room now
+        self.watchers: list[Callable[[types.User, bool], None]] = []
+
+    def watch(self, callback: Callable[[types.User, bool], None]) -> None:
+        self.watchers.append(callback)
+
+    def _changed(self, user: types.User) -> None:
+        busy = user.id in self.games or user.id in self.rooms
+        for callback in self.watchers:
+            callback(user, busy)
+
+    def game_of(self, user_id: int) -> durak.Game | None:
+        return self.games.get(user_id)
+
+    def room_of(self, user_id: int) -> "room.Room | None":
+        return self.rooms.get(user_id)
+
+    def user_id_by_mention(self, mention: str) -> int | None:
+        return self.mentions.get(mention)
+
+    def add_game(self, game: durak.Game) -> None:
+        for p in game.players:
+            self.games[p.user.id] = game
+            self._changed(p.user)
+
+    def remove_game(self, game: durak.Game) -> None:
+        for p in game.players:
+            # the user may already sit at a newer table
+            if self.games.get(p.user.id) is game:
+                del self.games[p.user.id]
+                self._changed(p.user)
+
+    def add_room_player(self, room, user: types.User) -> None:
+        self.rooms[user.id] = room
+        if user.username:
+            self.mentions[f"@{user.username}"] = user.id
+        self._changed(user)
+
+    def remove_room_player(self, room, user: types.User) -> None:
+        if self.rooms.get(user.id) is room:
+            del self.rooms[user.id]
+            if user.username and self.mentions.get(f"@{user.username}") == user.id:
+                del self.mentions[f"@{user.username}"]
+            self._changed(user)
+
+    def remove_room(self, room) -> None:
+        for p in room.players:
+            self.remove_room_player(room, p.user)
+
+
+
+class RoomRegistry:
+    """Active rooms by id and by the payload of their invite link"""
+
+    def __init__(self):
+        self.by_id: dict[str, "room.Room"] = {}
+        self.by_payload: dict[str, "room.Room"] = {}
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+    def __iter__(self):
+        return iter(list(self.by_id.values()))
+
+    def get(self, room_id: str) -> "room.Room | None":
+        return self.by_id.get(room_id)
+
+    def by_invite(self, payload: str) -> "room.Room | None":
+        return self.by_payload.get(payload)
+
+    def add(self, room) -> None:
+        self.by_id[room.unique_id] = room
+        self.by_payload[room.payload] = room
+
+    def remove(self, room) -> None:
+        self.by_id.pop(room.unique_id, None)
+        self.by_payload.pop(room.payload, None)
+
+
+users = UserRegistry()
+rooms = RoomRegistry()
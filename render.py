@@ -0,0 +1,114 @@
+import asyncio
+import logging
+
+from aiogram import Bot, exceptions
+
+import broadcast
+import config
+
+logger = logging.getLogger("bot")
+
+
+class LiveMessage:
+    """A message that is edited instead of being sent again"""
+
+    __slots__ = ("chat_id", "message_id", "shown", "wanted", "options", "flushing")
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.message_id: int | None = None
+        # (text, inline markup) of the message and what it should show
+        self.shown: tuple[str, str | None] | None = None
+        self.wanted: tuple[str, str | None] | None = None
+        self.options: dict = {}
+        self.flushing = False
+
+
+class Renderer:
+    """
+    Keeps one message per chat and key, e.g. the lobby of a room, and brings it
+    up to date with editMessageText. Changes made within `delay` seconds are
+    sent as one edit, and a message that would show the same content isn't touched.
+    Only inline keyboards can be edited, reply keyboards need a new message.
+    """
+
+    def __init__(self, broadcaster: broadcast.Broadcaster, delay: float = 0.5):
+        self.broadcaster = broadcaster
+        self.delay = delay
+        self.messages: dict[tuple[str, int], LiveMessage] = {}
+        self.tasks: set[asyncio.Task] = set()
+        self.sent = 0
+        self.edited = 0
+        self.skipped = 0
+        self.coalesced = 0
+
+    def show(self, key: str, chat_id: int, text: str, reply_markup: str | None = None, **kwargs) -> None:
+        """Schedules the message of the key in the chat to show the text. kwargs only apply to the first send"""
+        if (message := self.messages.get((key, chat_id))) is None:
+            message = self.messages[key, chat_id] = LiveMessage(chat_id)
+            message.options = kwargs
+        if message.flushing:
+            self.coalesced += 1
+        message.wanted = (text, reply_markup)
+        if not message.flushing:
+            message.flushing = True
+            task = asyncio.create_task(self._flush(message))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def forget(self, key: str) -> None:
+        """The messages of the key stay as they are and aren't updated any more"""
+        for chat_key in [k for k in self.messages if k[0] == key]:
+            del self.messages[chat_key]
+
+    async def _flush(self, message: LiveMessage) -> None:
+        try:
+            while True:
+                await asyncio.sleep(self.delay)
+                wanted = message.wanted
+                await self._render(message, wanted)
+                if message.wanted == wanted:
+                    return
+        except Exception:
+            logger.exception("Не удалось обновить сообщение в чате %s", message.chat_id)
+        finally:
+            message.flushing = False
+
+    async def _render(self, message: LiveMessage, wanted: tuple[str, str | None]) -> None:
+        if wanted == message.shown:
+            self.skipped += 1
+            return
+        text, markup = wanted
+        if message.message_id is not None:
+            try:
+                await self.broadcaster.edit(message.chat_id, message.message_id, text, reply_markup=markup)
+                self.edited += 1
+                message.shown = wanted
+                return
+            except exceptions.MessageNotModified:
+                # someone else's edit got there first, the content is already right
+                message.shown = wanted
+                return
+            except (exceptions.MessageToEditNotFound, exceptions.MessageCantBeEdited):
+                # deleted by the user or too old, the next one replaces it
+                message.message_id = None
+
+        sent = await self.broadcaster.send(message.chat_id, text, reply_markup=markup, **message.options)
+        if sent is not None:
+            self.sent += 1
+            message.message_id = sent.message_id
+            message.shown = wanted
+
+    def stats(self) -> dict[str, int]:
+        return {"live": len(self.messages), "sent": self.sent, "edited": self.edited,
+                "skipped": self.skipped, "coalesced": self.coalesced}
+
+
+_renderers: dict[int, Renderer] = {}
+
+
+def for_bot(bot: Bot) -> Renderer:
+    """Returns the shared renderer of the bot, it sends through the bot's broadcaster"""
+    if id(bot) not in _renderers:
+        _renderers[id(bot)] = Renderer(broadcast.for_bot(bot), delay=getattr(config, "RENDER_DELAY", 0.5))
+    return _renderers[id(bot)]
@@ -1,5 +1,4 @@
 import asyncio
-import contextlib
 import enum
 import random
 import logging
@@ -8,14 +7,35 @@ import uuid
 from datetime import datetime, timedelta
 
 import humanize
-from aiogram import Bot, exceptions, types
+from aiogram import Bot, types
 from aiogram.utils import deep_linking
 
+import bracket
+import broadcast
 import config
 import durak
+import matchmaker
+import movelog
+import persistence
+import registry
+import render
+import scoreboard
+import supervisor
 
 logger = logging.getLogger("bot")
 
+SCOREBOARD_DIGEST_INTERVAL = getattr(config, "SCOREBOARD_DIGEST_INTERVAL", 60)
+SCOREBOARD_TOP = getattr(config, "SCOREBOARD_TOP", 10)
+# games of a tournament table that end in a draw before its winner is drawn by lot
+TOURNAMENT_MAX_REPLAYS = getattr(config, "TOURNAMENT_MAX_REPLAYS", 3)
+# players listed with their IDs in the admin's digest of the lobby
+ADMIN_LOBBY_RECENT = 10
+# length of one message of the full player list, Telegram takes up to 4096 characters
+ROSTER_MESSAGE_CHARS = 4000
+# tables listed in the admin's message about a round
+MAX_ROUND_LINES = 50
+BYES = -1
+
 def format_time(unix_time: time.struct_time):
     return time.strftime("%d.%m.%Y %H:%M", unix_time)
 
@@ -48,12 +68,21 @@ class Gamemode(enum.IntEnum):
 
 
 class Room:
-    def __init__(self, start_time: datetime, end_time: datetime, max_players: int, gamemode: Gamemode, admin: types.User, bot):
-        self.admin = admin
+    __slots__ = ("admin", "bot", "broadcaster", "renderer", "running", "started", "start_time", "end_time", "max_players", "gamemode",
+                 "games", "matchmaker", "scoreboard", "unique_id", "payload", "invite_link", "players", "members",
+                 "rounds", "closed", "_everyone", "_players_only")
+
+    def __init__(self, start_time: datetime, end_time: datetime, max_players: int, gamemode: Gamemode,
+                 admin: types.User | registry.UserRef, bot, unique_id: str | None = None):
+        self.admin = registry.UserRef.of(admin)
         self.bot: Bot = bot
+        self.broadcaster = broadcast.for_bot(bot)
+        self.renderer = render.for_bot(bot)
 
         self.running = False
         self.started = False
+        # set once the saved room is deleted, so that a late game doesn't bring it back
+        self.closed = False
 
         self.start_time = start_time
         self.end_time = end_time
@@ -62,62 +91,178 @@ class Room:
         self.gamemode = gamemode
 
         self.games: list[durak.Game] = []
-        self.marathon_queue: list[durak.Player] = []
+        self.matchmaker = matchmaker.MarathonMatchmaker(lambda: len(self.players) == 2)
 
-        self.scores: list[int] = []
-        self.unique_id: uuid.UUID = str(uuid.uuid4())
+        self.scoreboard = scoreboard.Scoreboard()
+        self.unique_id: str = unique_id or str(uuid.uuid4())
+        # the /start argument of the invite link
+        self.payload = deep_linking.encode_payload(self.unique_id)
+        self.invite_link: str | None = None
         self.players: list[durak.Player] = []
+        # the same players by user id
+        self.members: dict[int, durak.Player] = {}
+        # tournament round -> table (BYES for the players without a table) -> line of the round summary
+        self.rounds: dict[int, dict[int, str]] = {}
+        self._everyone: tuple | None = None
+        self._players_only: tuple | None = None
+
+    def snapshot(self) -> dict:
+        return {
+            "unique_id": self.unique_id,
+            "admin": self.admin.to_python(),
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "max_players": self.max_players,
+            "gamemode": int(self.gamemode),
+            "started": self.started,
+            "players": [p.user.to_python() for p in self.players],
+            "scores": dict(self.scoreboard.scores),
+        }
+
+    @classmethod
+    def restore(cls, snapshot: dict, bot) -> "Room":
+        r = cls(snapshot["start_time"], snapshot["end_time"], snapshot["max_players"], Gamemode(snapshot["gamemode"]),
+                admin=types.User(**snapshot["admin"]), bot=bot, unique_id=snapshot["unique_id"])
+        r.started = snapshot["started"]
+        for user in snapshot["players"]:
+            user = types.User(**user)
+            r._add(player := durak.Player(user))
+            r.scoreboard.add(player, snapshot["scores"].get(user.id, 0))
+            registry.users.add_room_player(r, user)
+        return r
 
     @property
-    async def invite_link(self) -> str:
-        return await deep_linking.get_start_link(self.unique_id, encode=True)
+    def resumable(self) -> bool:
+        """
+        A marathon goes on after a restart from its saved scores. The bracket of a
+        started tournament isn't saved, running it again would bring back the eliminated players
+        """
+        return not (self.started and self.gamemode in Gamemode.tournament())
+
+    def save(self) -> None:
+        if not self.closed:
+            persistence.backend.save("room", self.unique_id, self.snapshot())
+
+    def forget(self) -> None:
+        self.closed = True
+        persistence.backend.delete("room", self.unique_id)
+
+    async def create_invite_link(self) -> str:
+        """The link is built once, aiogram keeps the bot's username after the first getMe"""
+        if self.invite_link is None:
+            self.invite_link = await deep_linking.get_start_link(self.payload)
+        return self.invite_link
 
     @property
-    def everyone(self) -> set[durak.Player]:
+    def everyone(self) -> tuple[types.User | registry.UserRef, ...]:
         """ Returns every player in the room and the admin who created it"""
-        return set([self.admin] + [i.user for i in self.players])
+        if self._everyone is None:
+            self._everyone = (self.admin, *self.players_only)
+        return self._everyone
 
     @property
-    def players_only(self) -> set[durak.Player]:
+    def players_only(self) -> tuple[types.User, ...]:
         """Returns every player in the room except the admin"""
-        return {i.user for i in self.players} - {self.admin}
+        if self._players_only is None:
+            self._players_only = tuple(p.user for p in self.players if p.user.id != self.admin.id)
+        return self._players_only
+
+    def _add(self, player: durak.Player) -> None:
+        self.players.append(player)
+        self.members[player.user.id] = player
+        self._everyone = self._players_only = None
 
     async def send_message(self, target: list[types.User], text: str, notifications: bool = True) -> None:
-        for u in target:
-            try:
-                await self.bot.send_message(u.id, text, disable_notification=not notifications)
-            except (exceptions.BotBlocked, exceptions.UserDeactivated, exceptions.ChatNotFound):
-                logger.info(f"{u.mention} ({u.id}) недоступен для бота, кикнут из комнаты {self.unique_id}")
-                await self.remove_player_from_user(u)
-                await self.send_message(self.everyone, f"{u.mention} заблокировал бота, или же бот по другим причинам не смог с ним связаться, поэтому пользователь вылетает из игры.")
-            except exceptions.RetryAfter as exc:
-                await asyncio.sleep(exc.timeout)
-                # Recursive call
-                await self.send_message([u], text, notifications=notifications)
+        await self.send_messages({u.id: (u, text) for u in target}, notifications=notifications)
+
+    def notify(self, target: list[types.User], text: str) -> None:
+        """send_message without holding up the caller, e.g. a game that is about to start"""
+        supervisor.games.spawn(self.send_message(target, text))
+
+    async def send_messages(self, messages: dict[int, tuple[types.User, str]], notifications: bool = True) -> None:
+        """Sends every user their own text"""
+        while messages:
+            unreachable = await self.broadcaster.broadcast_each({i: text for i, (_, text) in messages.items()},
+                                                                disable_notification=not notifications)
+            # everyone who blocked the bot during this broadcast is kicked at once
+            kicked = [messages[i][0] for i in unreachable if self._remove_player(messages[i][0])]
+            if not kicked:
+                return
+            for u in kicked:
+                logger.info("%s (%s) недоступен для бота, кикнут из комнаты %s", u.mention, u.id, self.unique_id, extra={"room": self.unique_id})
+            if len(kicked) == 1:
+                text = f"{kicked[0].mention} заблокировал бота, или же бот по другим причинам не смог с ним связаться, поэтому пользователь вылетает из игры."
+            else:
+                text = f"{', '.join(u.mention for u in kicked)} заблокировали бота, или же бот по другим причинам не смог с ними связаться, поэтому они вылетают из игры."
+            messages = {u.id: (u, text) for u in self.everyone}
+            notifications = True
 
     async def add_player_from_user(self, user: types.User) -> bool:
         # check if does not break
         if self.max_players and len(self.players) >= self.max_players:
             return False
-        if user in [p.user for p in self.players]:
+        if user.id in self.members:
             await self.send_message([user], "Вы уже присоединились к этой комнате!")
             return False
+        # the registry keeps one room per user
+        if registry.users.room_of(user.id) is not None:
+            await self.send_message([user], "Вы уже состоите в другой комнате. Выйдите из неё, чтобы присоединиться к этой.")
+            return False
 
-        self.players.append(durak.Player(user))
-        await self.send_message(self.players_only, f"{user.mention} добавился в комнату. Сейчас в комнате {len(self.players)} человек(а).")
-        await self.send_message([self.admin], f"{user.mention} добавился в комнату. Сейчас в комнате {len(self.players)} человек(а).\nID: {user.id}")
+        self._add(player := durak.Player(user))
+        self.scoreboard.add(player)
+        registry.users.add_room_player(self, user)
+        self.save()
+        self.show_lobby(f"{user.mention} добавился в комнату. Сейчас в комнате {len(self.players)} человек(а).")
+        self.show_admin_lobby(f"{user.mention} добавился в комнату. ID: {user.id}")
         return True
 
-    async def remove_player_from_user(self, user: types.User) -> None:
-        for player in self.players:
-            if player.user == user:
-                index = self.players.index(player)
-                self.players.pop(index)
-                with contextlib.suppress(IndexError):
-                    self.scores.pop(index)
-                with contextlib.suppress(ValueError):
-                    self.marathon_queue.remove(player)
-        await self.send_message(self.everyone, f"{user.mention} выходит из комнаты (осталось {len(self.players)} человек)")
+    def _remove_player(self, user: types.User) -> bool:
+        if (player := self.members.pop(user.id, None)) is None:
+            return False
+        self.players.remove(player)
+        self._everyone = self._players_only = None
+        self.scoreboard.remove(user.id)
+        self.matchmaker.discard(user.id)
+        registry.users.remove_room_player(self, user)
+        self.save()
+        return True
+
+    def show_lobby(self, text: str) -> None:
+        """Until the event starts the players see one message about who comes and goes, edited in place"""
+        for u in self.players_only:
+            self.renderer.show(f"lobby:{self.unique_id}", u.id, text)
+
+    def show_admin_lobby(self, text: str) -> None:
+        """
+        The admin's digest of the lobby: the latest change and the IDs of the last
+        players to join, in one message edited in place, so that joins don't wait
+        for the admin's chat. The IDs of everyone else are in the roster
+        """
+        recent = [f"{p.user.mention} — ID: {p.user.id}" for p in reversed(self.players[-ADMIN_LOBBY_RECENT:])]
+        self.renderer.show(f"admin:{self.unique_id}", self.admin.id,
+                           f"{text}\nСейчас в комнате {len(self.players)} человек(а).\n\nПоследние присоединившиеся:\n" + "\n".join(recent)
+                           + f"\n\nВсе игроки с ID: /players {self.unique_id}")
+
+    def roster(self) -> list[str]:
+        """Every player with their ID, split into messages"""
+        pages = [f"Игроки комнаты {self.unique_id} ({len(self.players)} чел.):"]
+        for p in self.players:
+            line = f"{p.user.mention} — ID: {p.user.id}"
+            if len(pages[-1]) + len(line) + 1 > ROSTER_MESSAGE_CHARS:
+                pages.append(line)
+            else:
+                pages[-1] += "\n" + line
+        return pages
+
+    def remove_player_from_user(self, user: types.User) -> None:
+        self._remove_player(user)
+        text = f"{user.mention} выходит из комнаты (осталось {len(self.players)} человек)"
+        if self.started:
+            self.notify(self.everyone, text)
+        else:
+            self.show_lobby(text)
+            self.show_admin_lobby(text)
 
     async def reschedule(self, delta: timedelta):
         if self.started:
@@ -125,140 +270,170 @@ class Room:
         self.start_time += delta
         if self.end_time:
             self.end_time += delta
+        self.save()
         
         event_eta = humanize.precisedelta(datetime.now() - self.start_time)
-        logger.info(f"Начало события в комнате {self.unique_id} перенесены на {event_eta}")
+        logger.info("Начало события в комнате %s перенесены на %s", self.unique_id, event_eta, extra={"room": self.unique_id})
         await self.send_message(self.everyone, f"Начало и конец события были перенесены. Игра начнётся через: {event_eta}")
 
-    async def split_tournament_players(self, players: list[durak.Player]) -> list[list[durak.Game]]:
-        def split_func(lst, sz): return [lst[i:i+sz]
-                                         for i in range(0, len(lst), sz)]
-        if not players:
-            return []
-
-        for players_per_game in range(6, 1, -1):
-            if len(players) % players_per_game == 0:
-                result = split_func(players, players_per_game)
-                print(len(players), "%", players_per_game)
-                return result if (await self.split_tournament_players(result)) != [] or len(result) == 1 else []
-        print(len(players), "% none")
-        return []
-
     async def marathon_gameloop(self, player1: durak.Player, player2: durak.Player) -> None:
-        game = durak.Game([player1, player2], bot=self.bot, move_time=config.SECONDS_FOR_MOVE,
-                          is_transferrable=(self.gamemode == Gamemode.MARATHON_TRANS))
+        game = movelog.journal.create_game([player1, player2], self.bot, is_transferrable=(self.gamemode == Gamemode.MARATHON_TRANS),
+                                           in_room=True)
         self.games.append(game)
-        logger.info(f"[{game.unique_id}] Начало раунда марафона в комнате {self.unique_id}")
-        winner = await game.game_loop()
+        logger.info("[%s] Начало раунда марафона в комнате %s", game.unique_id, self.unique_id, extra={"room": self.unique_id, "game": game.unique_id})
+        winner = await supervisor.games.play(game)
+        # the list is emptied when the room ends
+        if game in self.games:
+            self.games.remove(game)
+        if not self.running:
+            # the room has ended during the game, its results are already out
+            return
         if winner != "draw":
-            self.scores[self.players.index(winner)] += 1
+            self.scoreboard.win(winner.user.id)
+            self.save()
         player1.previously_played_with = player2
         player2.previously_played_with = player1
-        self.marathon_queue.extend([player1, player2])
-        self.games.remove(game)
-
-        results = '\n'.join(['{0} : {1}'.format(i.user.mention, j)
-                            for i, j in zip(self.players, self.scores)])
-        await self.send_message(self.everyone, f"Текущая таблица результатов:\n{results}")
+        for p in (player1, player2):
+            # players kicked during the game don't come back
+            if registry.users.room_of(p.user.id) is self:
+                self.matchmaker.put(p)
+
+    def show_results(self) -> None:
+        header = f"Текущая таблица результатов (топ-{SCOREBOARD_TOP}):\n{self.scoreboard.table(SCOREBOARD_TOP)}"
+        key = f"results:{self.unique_id}"
+        # one message with the table per user, edited as the results change
+        self.renderer.show(key, self.admin.id, header, disable_notification=True)
+        for p in self.players:
+            self.renderer.show(key, p.user.id, f"{header}\n\n{self.scoreboard.personal(p.user.id)}", disable_notification=True)
+
+    async def results_digest(self) -> None:
+        """Sends the results at most once per interval and only if they have changed"""
+        while self.running:
+            await asyncio.sleep(SCOREBOARD_DIGEST_INTERVAL)
+            if self.running and self.scoreboard.changed:
+                self.scoreboard.changed = False
+                self.show_results()
 
     async def process_marathon_winner(self) -> None:
-        if self.gamemode in Gamemode.marathon():
-            if self.scores.count(max(self.scores)) >= 2:
-                # find N max score indexes, then players
-                print(self.scores, self.players)
-                winners = [self.players[index] for index, score in enumerate(
-                    self.scores) if score == max(self.scores)]
+        if self.gamemode in Gamemode.marathon() and len(self.scoreboard):
+            winners = self.scoreboard.leaders()
+            if len(winners) >= 2:
                 winners_str = ', '.join(i.user.mention for i in winners)
                 
-                logger.info(f"Марафон в комнате {self.unique_id} закончился вничью между {winners_str}")
+                logger.info("Марафон в комнате %s закончился вничью между %s", self.unique_id, winners_str, extra={"room": self.unique_id})
                 await self.send_message(self.everyone, f"По итогам сыгранных раундов, игра закончилась вничью между {winners_str}!")
 
             else:
-                winner = self.players[self.scores.index(max(self.scores))]
-                logger.info(f"Марафон в комнате {self.unique_id} закончился победой {winner.user.mention} ({winner.user.id})")
+                winner = winners[0]
+                logger.info("Марафон в комнате %s закончился победой %s (%s)", self.unique_id, winner.user.mention, winner.user.id, extra={"room": self.unique_id})
                 await self.send_message(self.everyone, f"Итоговый победитель марафона по результатам сыгранных раундов: {winner.user.mention}!")
                 
-            results = '; '.join(['{0} : {1}'.format(i.user.mention, j)
-                            for i, j in zip(self.players, self.scores)])
-            logger.info(f"{self.unique_id}: таблица результатов - {results}")
+            results = self.scoreboard.table(separator="; ")
+            logger.info("%s: таблица результатов - %s", self.unique_id, results, extra={"room": self.unique_id})
 
     async def start(self) -> None:
-        if ((len(self.players) < 2 or len(self.players) % 2 != 0) and (self.gamemode in Gamemode.marathon())) or (not (await self.split_tournament_players(self.players)) and self.gamemode in Gamemode.tournament()):
+        if ((len(self.players) < 2 or len(self.players) % 2 != 0) and (self.gamemode in Gamemode.marathon())) or (not bracket.is_playable(len(self.players)) and self.gamemode in Gamemode.tournament()):
             await self.send_message(self.everyone, "Игра должна была начаться, но количество игроков в комнате не соответствует требованиям.")
             await self.reschedule(timedelta(minutes=2))
             return
 
+        self.renderer.forget(f"lobby:{self.unique_id}")
+        self.renderer.forget(f"admin:{self.unique_id}")
         random.shuffle(self.players)
-        self.scores = [0 for _ in range(len(self.players))]
+        self.scoreboard = scoreboard.Scoreboard()
+        for p in self.players:
+            self.scoreboard.add(p)
         self.started = True
+        self.save()
+
+    def start_marathon_game(self, player1: durak.Player, player2: durak.Player) -> None:
+        supervisor.games.spawn(self.marathon_gameloop(player1, player2))
 
-    async def marathon_loop(self) -> None:
-        if len(self.marathon_queue) >= 2:
-            for p in self.marathon_queue.copy():
-                pair_found = False
-                for p2 in self.marathon_queue.copy():
-                    if p2 is not p and (p.previously_played_with != p2 or len(self.players) == 2):
-                        asyncio.create_task(self.marathon_gameloop(p, p2))
-                        self.marathon_queue.remove(p)
-                        self.marathon_queue.remove(p2)
-                        pair_found = True
-                        break
-                    if pair_found:
-                        break
-        if self.running:
-            await asyncio.sleep(2)
-            await self.marathon_loop()
-
-    async def wait_for_games_to_end(self) -> list[durak.Player]:
-        async def tournament_loop(game: durak.Game):
-            winner = "draw"
-            while winner == "draw":
-                winner = await game.game_loop()
-                if winner == "draw":
-                    logger.info(f"[{game.unique_id}] Игра закончилась вничью, игроки переигрывают.")
-                    await self.send_message(list({self.admin, *game.players}), " vs ".join(i.user.mention for i in game.players) + "\n\nИгра закончилась вничью. Игроки переигрывают.")
+    async def play_tournament_table(self, round_index: int, table: int, players: list[durak.Player]) -> durak.Player:
+        game = movelog.journal.create_game([durak.Player(i.user) for i in players], self.bot,
+                                           is_transferrable=self.gamemode == Gamemode.TOURNAMENT_TRANS, in_room=True)
+        self.games.append(game)
+        self.show_round(round_index, table, f"стол {table + 1}: " + ", ".join(i.user.mention for i in players))
+        try:
+            for _ in range(TOURNAMENT_MAX_REPLAYS):
+                winner = await supervisor.games.play(game)
+                if winner != "draw":
+                    return winner
+                logger.info("[%s] Игра закончилась вничью, игроки переигрывают.", game.unique_id, extra={"game": game.unique_id})
+                self.notify([self.admin, *(i.user for i in game.players)], " vs ".join(i.user.mention for i in game.players) + "\n\nИгра закончилась вничью. Игроки переигрывают.")
+            # the table has drawn too many times, it doesn't hold up the rest of the bracket any longer
+            winner = random.choice(game.players)
+            logger.info("[%s] После %s ничьих в следующий раунд по жребию проходит %s (%s)", game.unique_id, TOURNAMENT_MAX_REPLAYS,
+                        winner.user.mention, winner.user.id, extra={"room": self.unique_id, "game": game.unique_id})
+            self.notify([self.admin, *(i.user for i in game.players)],
+                        f"Игра закончилась вничью {TOURNAMENT_MAX_REPLAYS} раз(а) подряд. По жребию в следующий раунд проходит {winner.user.mention}.")
             return winner
-        async with asyncio.TaskGroup() as tg:
-            tasks = [tg.create_task(tournament_loop(g)) for g in self.games]
-        return [t.result() for t in tasks]
+        finally:
+            # the list is emptied when the room ends
+            if game in self.games:
+                self.games.remove(game)
+
+    async def announce_byes(self, round_index: int, players: list[durak.Player]) -> None:
+        self.show_round(round_index, BYES, "без игры: " + ", ".join(i.user.mention for i in players))
+
+    def show_round(self, round_index: int, table: int, line: str) -> None:
+        """
+        The admin gets one message per round, edited as its tables start. Tables
+        don't wait for it: the admin's chat takes about a message a second
+        """
+        lines = self.rounds.setdefault(round_index, {})
+        lines[table] = line
+        shown = [lines[t] for t in sorted(lines) if t != BYES]
+        if len(shown) > MAX_ROUND_LINES:
+            shown = shown[:MAX_ROUND_LINES] + [f"... и ещё {len(shown) - MAX_ROUND_LINES} стол(ов)"]
+        if BYES in lines:
+            shown.append(lines[BYES])
+        self.renderer.show(f"round:{self.unique_id}:{round_index}", self.admin.id,
+                           f"Раунд {round_index + 1}\n" + "\n".join(shown), disable_notification=True)
 
     async def loop(self) -> None:
         self.running = True
         if self.gamemode in Gamemode.tournament():
-            winner = None
-            players = self.players.copy()
-            while not winner:
-                self.games = [durak.Game([durak.Player(i.user) for i in player_group], bot=self.bot, move_time=config.SECONDS_FOR_MOVE,
-                                         is_transferrable=self.gamemode == Gamemode.TOURNAMENT_TRANS) for player_group in (await self.split_tournament_players(players))]
-                
-                games_message_text = "Текущие столы:\n\n"
-                for index, player_group in enumerate(await self.split_tournament_players(players)):
-                    games_message_text += f"Стол {index + 1}: " + ", ".join(i.user.mention for i in player_group) + "\n"
-                await self.send_message([self.admin], games_message_text)
-
-                players = await self.wait_for_games_to_end()
-                if len(players) == 1:
-                    winner = players[0]
+            self.games = []
+            self.rounds = {}
+            tournament = bracket.Bracket(self.players.copy(), self.play_tournament_table, self.announce_byes)
+            winner = await tournament.run()
+            logger.info("Турнир в комнате %s: %s", self.unique_id, tournament.report(), extra={"room": self.unique_id})
 
             if self.running:
-                if winner != "draw":
-                    logger.info(f"Турнир в комнате {self.unique_id} закончился победой {winner.user.mention} ({winner.user.id})")
-                    await self.send_message(self.everyone, f"Поздравляем! Победитель турнира - {winner.user.mention}!")
-                else:
-                    logger.info(f"Турнир в комнате {self.unique_id} закончился вничью")
-                    await self.send_message(self.everyone, "Поздравляем! Турнир закончился вничью!")
+                logger.info("Турнир в комнате %s закончился победой %s (%s)", self.unique_id, winner.user.mention, winner.user.id, extra={"room": self.unique_id})
+                await self.send_message(self.everyone, f"Поздравляем! Победитель турнира - {winner.user.mention}!")
             self.games = []
         else:
-            self.marathon_queue = self.players.copy()
-            await self.marathon_loop()
+            for p in self.players:
+                self.matchmaker.put(p)
+            supervisor.games.spawn(self.results_digest())
+            await self.matchmaker.run(self.start_marathon_game)
 
     async def end(self) -> None:
         self.running = False
+        self.matchmaker.close()
+        if self.gamemode in Gamemode.marathon():
+            stats = self.matchmaker.stats()
+            logger.info("Марафон в комнате %s: %s игр, ожидание соперника в среднем %.1f с, p95 %.1f с, максимум %.1f с",
+                        self.unique_id, stats["pairs"], stats["wait_mean"], stats["wait_p95"], stats["wait_max"],
+                        extra={"room": self.unique_id})
         # different game endings due to timeout here
         await self.process_marathon_winner()
         if self.gamemode in Gamemode.tournament():
-            logger.info(f"Турнир в комнате {self.unique_id} закончился таймаутом")
+            logger.info("Турнир в комнате %s закончился таймаутом", self.unique_id, extra={"room": self.unique_id})
             await self.send_message(self.everyone, "Время на турнир вышло!")
         for game in self.games:
             game.running = False
+            registry.users.remove_game(game)
         self.games = []
+        self.forget_messages()
+
+    def forget_messages(self) -> None:
+        """The lobby and results messages stay as they are, the renderer lets go of them"""
+        self.renderer.forget(f"lobby:{self.unique_id}")
+        self.renderer.forget(f"admin:{self.unique_id}")
+        self.renderer.forget(f"results:{self.unique_id}")
+        for round_index in self.rounds:
+            self.renderer.forget(f"round:{self.unique_id}:{round_index}")
+        self.rounds = {}
@@ -0,0 +1,84 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable
+
+import room
+
+logger = logging.getLogger("bot")
+
+START = "start"
+END = "end"
+
+
+class RoomScheduler:
+    """
+    Fires the start and end events of rooms at their start_time and end_time.
+    Deadlines are kept in a heap; re-scheduling a room pushes new entries
+    and the old ones are skipped when they come up.
+    """
+
+    def __init__(self, on_start: Callable[[room.Room], Awaitable], on_end: Callable[[room.Room], Awaitable]):
+        self.handlers = {START: on_start, END: on_end}
+        self.heap: list[tuple[float, int, str, str]] = []
+        self.entries: dict[tuple[str, str], int] = {}
+        self.rooms: dict[str, room.Room] = {}
+        self.running: dict[str, asyncio.Task] = {}
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+
+    def _push(self, r: room.Room, kind: str, deadline: float) -> None:
+        seq = next(self.counter)
+        self.entries[(r.unique_id, kind)] = seq
+        heapq.heappush(self.heap, (deadline, seq, kind, r.unique_id))
+
+    def schedule(self, r: room.Room) -> None:
+        """Adds the room or re-keys it after its times have changed"""
+        self.rooms[r.unique_id] = r
+        self.entries.pop((r.unique_id, START), None)
+        self.entries.pop((r.unique_id, END), None)
+        if not r.started:
+            self._push(r, START, r.start_time.timestamp())
+        if r.end_time:
+            self._push(r, END, r.end_time.timestamp())
+        self.wakeup.set()
+
+    def cancel(self, r: room.Room) -> None:
+        self.rooms.pop(r.unique_id, None)
+        self.entries.pop((r.unique_id, START), None)
+        self.entries.pop((r.unique_id, END), None)
+
+    def _fire(self, r: room.Room, kind: str) -> None:
+        # events of one room run one after another, different rooms run concurrently
+        previous = self.running.get(r.unique_id)
+
+        async def run():
+            if previous:
+                with contextlib.suppress(Exception):
+                    await previous
+            try:
+                await self.handlers[kind](r)
+            except Exception:
+                logger.exception("Ошибка при обработке события %s комнаты %s", kind, r.unique_id, extra={"room": r.unique_id})
+
+        task = asyncio.create_task(run())
+        self.running[r.unique_id] = task
+        task.add_done_callback(lambda t: self.running.pop(r.unique_id, None) if self.running.get(r.unique_id) is t else None)
+
+    async def run(self) -> None:
+        while True:
+            now = time.time()
+            while self.heap and self.heap[0][0] <= now:
+                _, seq, kind, room_id = heapq.heappop(self.heap)
+                if self.entries.get((room_id, kind)) != seq:
+                    continue
+                del self.entries[(room_id, kind)]
+                self._fire(self.rooms[room_id], kind)
+
+            self.wakeup.clear()
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
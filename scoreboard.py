@@ -0,0 +1,76 @@
+import durak
+
+
+class Scoreboard:
+    """
+    Marathon scores keyed by user id. Players are grouped by score, so a win moves
+    one player to the next group and the ranking never has to be rebuilt
+    """
+
+    def __init__(self):
+        self.players: dict[int, durak.Player] = {}
+        self.scores: dict[int, int] = {}
+        # score -> user ids in the order they reached it
+        self.groups: dict[int, dict[int, None]] = {}
+        self.best = 0
+        self.changed = False
+
+    def __len__(self):
+        return len(self.players)
+
+    def _place(self, user_id: int, score: int) -> None:
+        self.scores[user_id] = score
+        self.groups.setdefault(score, {})[user_id] = None
+        self.best = max(self.best, score)
+
+    def _take(self, user_id: int) -> int:
+        score = self.scores.pop(user_id)
+        group = self.groups[score]
+        del group[user_id]
+        if not group:
+            del self.groups[score]
+            if score == self.best:
+                self.best = max(self.groups, default=0)
+        return score
+
+    def add(self, player: durak.Player, score: int = 0) -> None:
+        self.players[player.user.id] = player
+        self._place(player.user.id, score)
+
+    def remove(self, user_id: int) -> None:
+        if user_id in self.players:
+            del self.players[user_id]
+            self._take(user_id)
+            self.changed = True
+
+    def win(self, user_id: int) -> None:
+        if user_id in self.players:
+            self._place(user_id, self._take(user_id) + 1)
+            self.changed = True
+
+    def leaders(self) -> list[durak.Player]:
+        return [self.players[i] for i in self.groups.get(self.best, {})]
+
+    def ranking(self):
+        for score in sorted(self.groups, reverse=True):
+            for user_id in self.groups[score]:
+                yield self.players[user_id], score
+
+    def top(self, k: int) -> list[tuple[durak.Player, int]]:
+        result = []
+        for entry in self.ranking():
+            if len(result) == k:
+                break
+            result.append(entry)
+        return result
+
+    def rank(self, user_id: int) -> int:
+        score = self.scores[user_id]
+        return 1 + sum(len(group) for s, group in self.groups.items() if s > score)
+
+    def table(self, k: int | None = None, separator: str = "\n") -> str:
+        entries = self.top(k) if k else self.ranking()
+        return separator.join(f"{i.user.mention} : {score}" for i, score in entries)
+
+    def personal(self, user_id: int) -> str:
+        return f"Ваше место: {self.rank(user_id)} из {len(self)}, побед: {self.scores[user_id]}"
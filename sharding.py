@@ -0,0 +1,335 @@
+"""
+Runs the bot as a front process and SHARDS worker processes.
+
+The front receives the updates and forwards each one to the worker that owns
+the user: the one running their game or room, otherwise user_id % SHARDS.
+It also runs the quick-match matchmaker, so players of different workers can be
+seated together; the game is started by the worker of the first player of the table.
+Workers report over a Unix socket which users they own and which rooms they run.
+A worker that dies is restarted and restores its rooms and games from its own
+state database and move log.
+
+    python sharding.py --worker 0 --socket durak.sock   # started by the front
+"""
+import argparse
+import asyncio
+import collections
+import contextlib
+import itertools
+import json
+import logging
+import os
+import signal
+import sys
+from typing import Callable
+
+import aiogram
+from aiogram import types
+
+import config
+import matchmaker
+import persistence
+import registry
+import webhook
+
+logger = logging.getLogger("bot")
+
+LINE_LIMIT = 2 ** 20
+BACKLOG = 10000
+# admin commands whose argument is a room id, they go to the worker running the room
+ROOM_COMMANDS = ("delete", "delete_room", "cancel_room", "players", "room_players")
+
+# set in worker processes
+link: "Link | None" = None
+
+
+def user_of(update: types.Update) -> int | None:
+    for name in ("message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+                 "my_chat_member", "chat_member", "chat_join_request"):
+        event = getattr(update, name, None)
+        if event is not None and event.from_user:
+            return event.from_user.id
+    return None
+
+
+class Shard:
+    def __init__(self, index: int):
+        self.index = index
+        self.process: asyncio.subprocess.Process | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        # updates for a worker that is (re)starting
+        self.backlog: collections.deque[bytes] = collections.deque(maxlen=BACKLOG)
+
+    @property
+    def connected(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
+
+    def send(self, message: dict) -> None:
+        line = json.dumps(message, ensure_ascii=False).encode() + b"\n"
+        if self.connected:
+            self.writer.write(line)
+        else:
+            self.backlog.append(line)
+
+    def attach(self, writer: asyncio.StreamWriter) -> None:
+        self.writer = writer
+        while self.backlog:
+            writer.write(self.backlog.popleft())
+
+
+class Front(aiogram.Dispatcher):
+    """Dispatcher that doesn't handle updates itself but routes them to the workers"""
+
+    def __init__(self, bot: aiogram.Bot, shards: int, socket_path: str):
+        super().__init__(bot)
+        self.shards = [Shard(i) for i in range(shards)]
+        self.socket_path = socket_path
+        self.server: asyncio.AbstractServer | None = None
+        self.watchers: set[asyncio.Task] = set()
+        self.closing = False
+
+        self.owners: dict[int, int] = {}
+        # "@username" -> user id, the only mentions /kick accepts
+        self.mentions: dict[str, int] = {}
+        self.rooms: dict[str, int] = {}
+        # invite payload -> room id
+        self.invites: dict[str, str] = {}
+        self.matchmaking = matchmaker.QueueMatchmaker(matchmaker.Ratings(),
+                                                      window=getattr(config, "MATCH_RATING_WINDOW", 100),
+                                                      growth=getattr(config, "MATCH_WINDOW_GROWTH", 10))
+
+    def route(self, update: types.Update) -> int:
+        message = update.message
+        if message and message.is_command() and (args := message.get_args()):
+            command = message.get_command(pure=True)
+            if command == "start":
+                if (room_id := self.invites.get(args)) is not None:
+                    return self.rooms[room_id]
+            elif command in ROOM_COMMANDS and args in self.rooms:
+                return self.rooms[args]
+            elif command == "kick":
+                user_id = int(args) if args.isdigit() else self.mentions.get(args)
+                if user_id in self.owners:
+                    return self.owners[user_id]
+
+        user_id = user_of(update)
+        if user_id is None:
+            return 0
+        return self.owners.get(user_id, user_id % len(self.shards))
+
+    async def process_update(self, update: types.Update):
+        shard = self.shards[self.route(update)]
+        shard.send({"update": update.to_python()})
+        if shard.connected:
+            await shard.writer.drain()
+
+    def enqueue(self, user: dict, queue: str, size: int) -> dict:
+        added = self.matchmaking.put(registry.UserRef.from_python(user), queue, size)
+        return {"already": not added, "length": self.matchmaking.length(queue)}
+
+    def start_table(self, queue: str, users: list[registry.UserRef]) -> None:
+        # every player of the table moves to the worker that starts the game
+        shard = self.shards[self.owners.get(users[0].id, users[0].id % len(self.shards))]
+        for user in users:
+            self.owners[user.id] = shard.index
+        shard.send({"match": {"queue": queue, "users": [u.to_python() for u in users]}})
+
+    def handle(self, shard: Shard, message: dict) -> None:
+        op = message["op"]
+        if op == "own":
+            self.owners[message["user_id"]] = shard.index
+            if message["mention"].startswith("@"):
+                self.mentions[message["mention"]] = message["user_id"]
+        elif op == "release":
+            if self.owners.get(message["user_id"]) == shard.index:
+                del self.owners[message["user_id"]]
+                if self.mentions.get(message["mention"]) == message["user_id"]:
+                    del self.mentions[message["mention"]]
+        elif op == "room":
+            self.rooms[message["room"]] = shard.index
+            self.invites[message["payload"]] = message["room"]
+        elif op == "room_closed":
+            self.rooms.pop(message["room"], None)
+            self.invites.pop(message["payload"], None)
+        elif op == "enqueue":
+            shard.send({"id": message["id"], "result": self.enqueue(message["user"], message["queue"], message["size"])})
+        elif op == "dequeue":
+            shard.send({"id": message["id"], "result": self.matchmaking.discard(message["user_id"], message["queue"])})
+        elif op == "result":
+            self.matchmaking.ratings.record(message["user_ids"], message["winner_id"])
+        else:
+            logger.warning("Неизвестное сообщение от воркера %s: %s", shard.index, op)
+
+    async def connected(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        shard = self.shards[json.loads(await reader.readline())["shard"]]
+        shard.attach(writer)
+        logger.info("Воркер %s подключился", shard.index)
+        try:
+            while line := await reader.readline():
+                self.handle(shard, json.loads(line))
+        finally:
+            if shard.writer is writer:
+                shard.writer = None
+            writer.close()
+
+    def forget(self, shard: Shard) -> None:
+        """Drops everything the dead worker owned, its users go back to their default workers"""
+        for user_id in [u for u, s in self.owners.items() if s == shard.index]:
+            del self.owners[user_id]
+        for mention in [m for m, u in self.mentions.items() if u not in self.owners]:
+            del self.mentions[mention]
+        for room_id in [r for r, s in self.rooms.items() if s == shard.index]:
+            del self.rooms[room_id]
+        for payload in [p for p, r in self.invites.items() if r not in self.rooms]:
+            del self.invites[payload]
+
+    async def spawn(self, shard: Shard) -> None:
+        shard.process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), "--worker", str(shard.index), "--socket", self.socket_path)
+        task = asyncio.create_task(self.watch(shard))
+        self.watchers.add(task)
+        task.add_done_callback(self.watchers.discard)
+
+    async def watch(self, shard: Shard) -> None:
+        code = await shard.process.wait()
+        if self.closing:
+            return
+        logger.error("Воркер %s завершился с кодом %s, перезапуск", shard.index, code)
+        self.forget(shard)
+        await asyncio.sleep(1)
+        await self.spawn(shard)
+
+    async def start(self) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.socket_path)
+        self.server = await asyncio.start_unix_server(self.connected, path=self.socket_path, limit=LINE_LIMIT)
+        self.matchmaking.ratings.restore()
+        self.matchmaking.restore()
+        for shard in self.shards:
+            await self.spawn(shard)
+        self.watchers.add(asyncio.create_task(self.matchmaking.run(self.start_table)))
+
+    async def stop(self) -> None:
+        self.closing = True
+        self.matchmaking.close()
+        processes = [s.process for s in self.shards if s.process and s.process.returncode is None]
+        for process in processes:
+            process.terminate()
+        await asyncio.gather(*(p.wait() for p in processes))
+        self.server.close()
+
+
+class Link:
+    """Connection of a worker to the front"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        # starts the game of a table found by the front
+        self.on_match: Callable[[str, list[registry.UserRef]], None] | None = None
+        self.ids = itertools.count()
+        self.requests: dict[int, asyncio.Future] = {}
+        self.tasks: set[asyncio.Task] = set()
+
+    def notify(self, op: str, **kwargs) -> None:
+        self.writer.write(json.dumps({"op": op, **kwargs}, ensure_ascii=False).encode() + b"\n")
+
+    async def request(self, op: str, **kwargs):
+        request_id = next(self.ids)
+        self.requests[request_id] = future = asyncio.get_running_loop().create_future()
+        self.notify(op, id=request_id, **kwargs)
+        return await future
+
+    def on_user_changed(self, user: types.User, busy: bool) -> None:
+        self.notify("own" if busy else "release", user_id=user.id, mention=user.mention)
+
+    async def run(self, dp: aiogram.Dispatcher) -> None:
+        async def process(update: types.Update):
+            aiogram.Bot.set_current(dp.bot)
+            aiogram.Dispatcher.set_current(dp)
+            try:
+                await dp.process_update(update)
+            except Exception:
+                logger.exception("Ошибка при обработке обновления %s", update.update_id)
+
+        while line := await self.reader.readline():
+            message = json.loads(line)
+            if "update" in message:
+                task = asyncio.create_task(process(types.Update(**message["update"])))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            elif "match" in message:
+                self.on_match(message["match"]["queue"], [registry.UserRef.from_python(u) for u in message["match"]["users"]])
+            else:
+                self.requests.pop(message["id"]).set_result(message["result"])
+
+
+def configure_worker(index: int) -> None:
+    """Gives the worker its own state database, move log, log file, metrics port and share of the send rate"""
+    if path := getattr(config, "STATE_DB_PATH", None):
+        config.STATE_DB_PATH = f"{path}.shard{index}"
+    if path := getattr(config, "MOVE_LOG_DIR", None):
+        config.MOVE_LOG_DIR = os.path.join(path, f"shard{index}")
+    root, ext = os.path.splitext(getattr(config, "LOG_PATH", "log/bot.log"))
+    config.LOG_PATH = f"{root}.shard{index}{ext}"
+    if port := getattr(config, "METRICS_PORT", None):
+        config.METRICS_PORT = port + 1 + index
+    # the Telegram limit is per bot token, the workers share it
+    config.BROADCAST_RATE = getattr(config, "BROADCAST_RATE", 25) / config.SHARDS
+    # only the front talks to Telegram about updates
+    config.WEBHOOK_URL = None
+
+
+async def serve_worker(index: int, socket_path: str) -> None:
+    global link
+    import bot as app
+
+    reader, writer = await asyncio.open_unix_connection(socket_path, limit=LINE_LIMIT)
+    writer.write(json.dumps({"shard": index}).encode() + b"\n")
+    link = Link(reader, writer)
+    link.on_match = app.start_table
+    registry.users.watch(link.on_user_changed)
+
+    await app.on_startup(app.dp)
+    task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    try:
+        await link.run(app.dp)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await app.on_shutdown(app.dp)
+        await (await app.bot.get_session()).close()
+
+
+def run(bot: aiogram.Bot, shards: int) -> None:
+    front = Front(bot, shards, getattr(config, "SHARD_SOCKET", "durak.sock"))
+
+    async def on_startup(_dp):
+        await front.start()
+
+    async def on_shutdown(_dp):
+        await front.stop()
+        persistence.backend.close()
+
+    if getattr(config, "WEBHOOK_URL", None):
+        webhook.run(front, on_startup=on_startup, on_shutdown=on_shutdown)
+    else:
+        aiogram.executor.start_polling(front, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--worker", type=int, required=True)
+    parser.add_argument("--socket", required=True)
+    args = parser.parse_args()
+    configure_worker(args.worker)
+    asyncio.run(serve_worker(args.worker, args.socket))
+    return 0
+
+
+if __name__ == "__main__":
+    # run through the imported module, bot.py sees the same `link`.
+    # Nothing imported above may read the config at import time, configure_worker changes it
+    import sharding
+    sys.exit(sharding.main())
@@ -0,0 +1,209 @@
+import asyncio
+import bisect
+import collections
+import contextvars
+import functools
+import logging
+import time
+from typing import Callable
+
+import aiogram
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils import exceptions
+from aiohttp import web
+
+logger = logging.getLogger("bot")
+
+# upper bounds in seconds, the last bucket is +Inf
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_handler: contextvars.ContextVar[str] = contextvars.ContextVar("stats_handler", default="unhandled")
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Interpolates the q-th value within its bucket"""
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(BUCKETS, self.counts):
+            if count and seen + count >= rank:
+                return min(lower + (bound - lower) * (rank - seen) / count, self.max)
+            seen += count
+            lower = bound
+        return self.max
+
+    def cumulative(self):
+        seen = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), self.counts):
+            seen += count
+            yield bound, seen
+
+
+class Metrics:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.updates = 0
+        self.handlers: dict[str, Histogram] = collections.defaultdict(Histogram)
+        self.handler_errors: collections.Counter[str] = collections.Counter()
+        self.api: dict[str, Histogram] = collections.defaultdict(Histogram)
+        self.api_errors: collections.Counter[str] = collections.Counter()
+        self.flood_waits = 0
+        self.loop_lag = Histogram()
+        self.gauges: dict[str, Callable[[], float]] = {}
+
+    def gauge(self, name: str, getter: Callable[[], float]) -> None:
+        self.gauges[name] = getter
+
+    @property
+    def uptime(self) -> float:
+        return time.monotonic() - self.started
+
+    def report(self) -> str:
+        uptime = self.uptime
+        lines = [f"Аптайм: {uptime:.0f} с., апдейтов: {self.updates} ({self.updates / uptime:.1f}/с)", "",
+                 "Обработчики (вызовы, p50/p99/max мс, ошибки):"]
+        for name, h in sorted(self.handlers.items(), key=lambda item: -item[1].sum):
+            lines.append(f"{name}: {h.count}, {h.quantile(0.5) * 1000:.0f}/{h.quantile(0.99) * 1000:.0f}/{h.max * 1000:.0f}, {self.handler_errors[name]}")
+
+        calls = sum(h.count for h in self.api.values())
+        lines += ["", f"Bot API: {calls} вызовов, flood-wait: {self.flood_waits}, ошибок: {sum(self.api_errors.values())}"]
+        for method, h in sorted(self.api.items(), key=lambda item: -item[1].count)[:10]:
+            lines.append(f"{method}: {h.count}, {h.quantile(0.5) * 1000:.0f}/{h.quantile(0.99) * 1000:.0f}/{h.max * 1000:.0f}")
+
+        lines += ["", f"Задержка event loop: p99 {self.loop_lag.quantile(0.99) * 1000:.0f} мс, max {self.loop_lag.max * 1000:.0f} мс"]
+        lines += [f"{name}: {getter()}" for name, getter in self.gauges.items()]
+        return "\n".join(lines)
+
+    def prometheus(self) -> str:
+        lines = []
+
+        def histogram(name: str, label: str, histograms: dict[str, Histogram]):
+            lines.append(f"# TYPE {name} histogram")
+            for key, h in histograms.items():
+                labels = f'{label}="{key}",' if label else ""
+                for bound, seen in h.cumulative():
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{name}_bucket{{{labels}le="{le}"}} {seen}')
+                labels = f"{{{labels.rstrip(',')}}}" if label else ""
+                lines.append(f"{name}_sum{labels} {h.sum}")
+                lines.append(f"{name}_count{labels} {h.count}")
+
+        def counter(name: str, label: str, counts: collections.Counter):
+            lines.append(f"# TYPE {name} counter")
+            for key, value in counts.items():
+                lines.append(f'{name}{{{label}="{key}"}} {value}')
+
+        lines += ["# TYPE durak_updates_total counter", f"durak_updates_total {self.updates}"]
+        histogram("durak_handler_seconds", "handler", self.handlers)
+        counter("durak_handler_errors_total", "handler", self.handler_errors)
+        histogram("durak_api_seconds", "method", self.api)
+        counter("durak_api_errors_total", "method", self.api_errors)
+        lines += ["# TYPE durak_flood_waits_total counter", f"durak_flood_waits_total {self.flood_waits}"]
+        histogram("durak_loop_lag_seconds", "", {"": self.loop_lag})
+        for name, getter in self.gauges.items():
+            lines += [f"# TYPE durak_{name} gauge", f"durak_{name} {getter()}"]
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class StatsMiddleware(BaseMiddleware):
+    """Times every dispatched handler, from the filters to the end of the handler"""
+
+    def __init__(self, metrics: Metrics):
+        super().__init__()
+        self.metrics = metrics
+
+    async def trigger(self, action: str, args):
+        stage, _, kind = action.rpartition("process_")
+        # updates pass the "update" stage only with polling, every update passes one of the others
+        if kind in ("update", "error"):
+            return
+
+        data = args[-1]
+        if stage == "pre_":
+            self.metrics.updates += 1
+            data["stats_started"] = time.perf_counter()
+        elif stage == "":
+            _handler.set(current_handler.get().__name__)
+        elif "stats_started" in data:
+            self.metrics.handlers[_handler.get()].observe(time.perf_counter() - data["stats_started"])
+
+    async def on_error(self, update: aiogram.types.Update, exception: Exception):
+        self.metrics.handler_errors[_handler.get()] += 1
+
+
+def timed(handler):
+    """Records a sub-handler called from a dispatched one under its own name"""
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        finally:
+            metrics.handlers[handler.__name__].observe(time.perf_counter() - started)
+    return wrapper
+
+
+def instrument(bot: aiogram.Bot) -> None:
+    """Wraps the current Bot.request of the bot to time every API call"""
+    request = bot.request
+
+    async def timed_request(method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await request(method, data, files, **kwargs)
+        except exceptions.RetryAfter:
+            metrics.flood_waits += 1
+            raise
+        except exceptions.TelegramAPIError:
+            metrics.api_errors[method] += 1
+            raise
+        finally:
+            metrics.api[method].observe(time.perf_counter() - started)
+
+    bot.request = timed_request
+
+
+def setup(dp: aiogram.Dispatcher) -> None:
+    middleware = StatsMiddleware(metrics)
+    dp.middleware.setup(middleware)
+    dp.register_errors_handler(middleware.on_error)
+    instrument(dp.bot)
+
+
+async def watch_loop(interval: float = 0.5) -> None:
+    """Measures how late the event loop wakes up a sleeping task"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        metrics.loop_lag.observe(max(0.0, time.perf_counter() - started - interval))
+
+
+async def serve(host: str, port: int) -> web.AppRunner:
+    """Starts the Prometheus text endpoint on /metrics"""
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.prometheus(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Метрики доступны на http://%s:%s/metrics", host, port)
+    return runner
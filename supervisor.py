@@ -0,0 +1,76 @@
+import asyncio
+import logging
+from typing import Coroutine
+
+import config
+import durak
+import movelog
+import registry
+
+logger = logging.getLogger("bot")
+
+
+class GameSupervisor:
+    """Runs games as tracked background tasks with a cap on how many play at once"""
+
+    def __init__(self, max_games: int):
+        self.slots = asyncio.Semaphore(max_games)
+        self.games: set[durak.Game] = set()
+        self.tasks: set[asyncio.Task] = set()
+
+    @property
+    def live(self) -> int:
+        return len(self.games)
+
+    async def play(self, game: durak.Game) -> durak.Player | str:
+        """Plays the game to the end inside a slot and returns its winner"""
+        async with self.slots:
+            self.games.add(game)
+            registry.users.add_game(game)
+            winner = None
+            try:
+                winner = await movelog.journal.play(game)
+                return winner
+            finally:
+                movelog.journal.finish(game, winner)
+                registry.users.remove_game(game)
+                self.games.discard(game)
+
+    def spawn(self, coro: Coroutine) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self._on_done)
+        return task
+
+    def launch(self, game: durak.Game) -> asyncio.Task:
+        # players count as busy while the game waits for a free slot
+        registry.users.add_game(game)
+        if self.slots.locked():
+            logger.info("[%s] Достигнут лимит одновременных игр (%s), игра ждёт свободного места", game.unique_id, self.live, extra={"game": game.unique_id})
+        task = self.spawn(self.play(game))
+        task.add_done_callback(lambda _: registry.users.remove_game(game))
+        return task
+
+    def adopt(self, game: durak.Game, task: asyncio.Task) -> None:
+        """Tracks a game whose loop is already running, e.g. one rebuilt from its move log"""
+        self.games.add(game)
+        registry.users.add_game(game)
+        self.tasks.add(task)
+
+        def done(t: asyncio.Task):
+            self.games.discard(game)
+            registry.users.remove_game(game)
+            movelog.journal.finish(game, None if t.cancelled() or t.exception() else t.result())
+            self._on_done(t)
+
+        task.add_done_callback(done)
+
+    def _on_done(self, task: asyncio.Task) -> None:
+        self.tasks.discard(task)
+        if task.cancelled():
+            return
+        if exc := task.exception():
+            logger.error("Фоновая задача %s упала", task.get_name(), exc_info=exc)
+
+
+games = GameSupervisor(getattr(config, "MAX_CONCURRENT_GAMES", 1000))
@@ -0,0 +1,39 @@
+import asyncio
+import datetime
+import unittest
+
+from aiogram import types
+
+import bot as app
+import fake_telegram
+import registry
+import render
+import room
+
+
+async def offline_request(method, data=None, files=None, **kwargs):
+    return fake_telegram.fake_result(method, data or {})
+
+
+class DeletedRoomTest(unittest.IsolatedAsyncioTestCase):
+    async def test_deleted_room_leaves_no_live_messages(self):
+        app.bot.request = offline_request
+        renderer = render.for_bot(app.bot)
+        admin = types.User(id=10 ** 9, is_bot=False, first_name="Admin")
+        r = room.Room(datetime.datetime.now() + datetime.timedelta(hours=1), None, None, room.Gamemode.MARATHON_DEFAULT,
+                      admin=admin, bot=app.bot)
+        app.add_room(r)
+        for user_id in range(1, 4):
+            await r.add_player_from_user(types.User(id=user_id, is_bot=False, first_name=f"Player {user_id}"))
+        await asyncio.sleep(renderer.delay * 2)
+        self.assertTrue(renderer.messages)
+
+        # what /delete does with a room that hasn't started
+        app.room_lifecycle.discard(r)
+        await asyncio.sleep(renderer.delay * 2)
+        self.assertIsNone(registry.rooms.get(r.unique_id))
+        self.assertEqual(renderer.messages, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+import timers
+
+
+class TimerWheelTest(unittest.TestCase):
+    def fire_tick(self, wheel: timers.TimerWheel, delay: float) -> int:
+        """Number of advances after which a deadline of `delay` fires"""
+        fired = []
+        wheel.arm(delay, lambda: fired.append(True))
+        for tick in range(1, 4 * len(wheel.slots) + 1):
+            wheel.advance()
+            if fired:
+                return tick
+        self.fail(f"a deadline of {delay} s never fired")
+
+    def test_deadlines_fire_on_their_tick(self):
+        wheel = timers.TimerWheel(tick=0.25, slots=8)
+        for ticks in (1, 2, 7, 8, 9, 16, 17):
+            with self.subTest(ticks=ticks):
+                self.assertEqual(self.fire_tick(wheel, ticks * wheel.tick), ticks)
+
+    def test_whole_turn_of_the_wheel(self):
+        wheel = timers.TimerWheel(tick=0.25, slots=8)
+        # a whole number of turns used to land in the current bucket and fire one turn late
+        self.assertEqual(self.fire_tick(wheel, len(wheel.slots) * wheel.tick), len(wheel.slots))
+        for _ in range(3):
+            wheel.advance()
+        self.assertEqual(self.fire_tick(wheel, len(wheel.slots) * wheel.tick), len(wheel.slots))
+
+    def test_cancelled_deadline_does_not_fire(self):
+        wheel = timers.TimerWheel(tick=0.25, slots=8)
+        fired = []
+        timer = wheel.arm(1, lambda: fired.append(True))
+        wheel.cancel(timer)
+        for _ in range(16):
+            wheel.advance()
+        self.assertEqual(fired, [])
+        self.assertEqual(len(wheel), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+import aiogram
+from aiogram import types
+from aiohttp import web
+
+import config
+
+logger = logging.getLogger("bot")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """
+    Receives updates from Telegram over HTTP. Every update is acknowledged at once
+    and processed in a tracked task, so shutdown can wait for handlers in flight.
+    """
+
+    def __init__(self, dp: aiogram.Dispatcher, path: str, secret: str | None = None, drain_timeout: float = 30):
+        self.dp = dp
+        self.path = path
+        self.secret = secret
+        self.drain_timeout = drain_timeout
+        self.accepting = True
+        self.tasks: set[asyncio.Task] = set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get(SECRET_HEADER) != self.secret:
+            return web.Response(status=403)
+        if not self.accepting:
+            # Telegram keeps the update and delivers it again after the restart
+            return web.Response(status=503)
+
+        update = types.Update(**(await request.json()))
+        task = asyncio.create_task(self.process(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response()
+
+    async def process(self, update: types.Update) -> None:
+        aiogram.Bot.set_current(self.dp.bot)
+        aiogram.Dispatcher.set_current(self.dp)
+        try:
+            await self.dp.process_update(update)
+        except Exception:
+            logger.exception("Ошибка при обработке обновления %s", update.update_id)
+
+    async def drain(self) -> None:
+        self.accepting = False
+        if not self.tasks:
+            return
+        logger.info("Ожидание завершения %s обработчиков", len(self.tasks))
+        _, pending = await asyncio.wait(self.tasks, timeout=self.drain_timeout)
+        if pending:
+            logger.warning("%s обработчиков не успели завершиться за %s с.", len(pending), self.drain_timeout)
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+
+def run(dp: aiogram.Dispatcher, on_startup: Callable[[aiogram.Dispatcher], Awaitable] | None = None,
+        on_shutdown: Callable[[aiogram.Dispatcher], Awaitable] | None = None) -> None:
+    """Starts the bot in webhook mode using the WEBHOOK_* settings from config"""
+    path = getattr(config, "WEBHOOK_PATH", "/webhook")
+    url = config.WEBHOOK_URL.rstrip("/") + path
+    secret = getattr(config, "WEBHOOK_SECRET", None)
+    server = WebhookServer(dp, path, secret=secret, drain_timeout=getattr(config, "WEBHOOK_DRAIN_TIMEOUT", 30))
+    app = server.make_app()
+
+    async def startup(_app):
+        aiogram.Bot.set_current(dp.bot)
+        aiogram.Dispatcher.set_current(dp)
+        # pending updates are kept, so moves sent during a restart are not lost
+        await dp.bot.set_webhook(url, secret_token=secret, drop_pending_updates=False)
+        logger.info("Вебхук установлен: %s", url)
+        if on_startup:
+            await on_startup(dp)
+
+    async def shutdown(_app):
+        # the webhook itself is left in place for the next start
+        await server.drain()
+        if on_shutdown:
+            await on_shutdown(dp)
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+        await (await dp.bot.get_session()).close()
+
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    web.run_app(app, host=getattr(config, "WEBHOOK_HOST", "127.0.0.1"), port=getattr(config, "WEBHOOK_PORT", 8080),
+                print=None)